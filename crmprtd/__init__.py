@@ -48,21 +48,29 @@ failures. This phase needs to manage the database transactions for
 speed and reliability. This phase is common to all networks.
 """
 
+import os
 import logging
 import logging.config
+import tempfile
 import yaml
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from pkg_resources import resource_stream
 from collections import namedtuple
-from itertools import tee
-from crmprtd.align import align
-from crmprtd.insert import insert
+from itertools import islice
+from crmprtd.align import Aligner
+from crmprtd.rowbatch import RowBatch
+from crmprtd.insert import insert_batches, pool_size, AdaptiveChunker, \
+    load_chunk_size, save_chunk_size
+from crmprtd.stages import threaded, in_process
 
 
 Row = namedtuple('Row', "time val variable_name unit network_name \
                          station_id lat lon")
 
+# Number of rows aligned at a time when the pipeline phases overlap
+OVERLAP_BATCH_SIZE = 10000
+
 
 def logging_args(parser):
     parser.add_argument('-L', '--log_conf',
@@ -114,10 +122,8 @@ def common_script_arguments(parser):    # pragma: no cover
     parser.add_argument('-i', '--input_file',
                         help='Input file to process')
     parser.add_argument('--sample_size', type=int,
-                        default=50,
-                        help='Number of samples to be taken from observations '
-                             'when searching for duplicates '
-                             'to determine which insertion strategy to use')
+                        help='Deprecated and ignored. Existing observations '
+                             'are now found exactly before insertion')
     return parser
 
 
@@ -161,33 +167,134 @@ def subset_dict(a_dict, keys_wanted):
     return {key: a_dict[key] for key in keys_wanted if key in a_dict}
 
 
+def batched(iterable, batch_size=None):
+    '''Splits an iterable into lists of at most batch_size items,
+       consuming it lazily. If batch_size is None, yields a single list
+       of all of the items.
+    '''
+    it = iter(iterable)
+    if batch_size is None:
+        yield list(it)
+        return
+    while True:
+        batch = list(islice(it, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def write_through(iterable, filename):
+    '''Writes each chunk of an iterable to a file as it is yielded
+
+       The chunks go to a temporary file which only replaces filename
+       once the iterable is exhausted, so that a download which fails
+       (or is not read to the end) never leaves a partial file behind.
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filename) or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for chunk in iterable:
+                f.write(chunk)
+                yield chunk
+        os.replace(tmp_path, filename)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def chunk_size_path(snapshot_file):
+    '''Returns the path of the file which holds the chunk size of the
+       run which saved the given metadata snapshot
+    '''
+    return os.path.splitext(snapshot_file)[0] + '.chunk_size'
+
+
+def load_snapshot(aligner, snapshot_file):
+    '''Warms up the aligner's cache from a metadata snapshot and returns
+       an AdaptiveChunker starting at the chunk size saved along with it
+       (see save_snapshot())
+    '''
+    aligner.load_snapshot(snapshot_file)
+    return AdaptiveChunker(load_chunk_size(chunk_size_path(snapshot_file)))
+
+
+def save_snapshot(aligner, chunker, snapshot_file):
+    '''Saves the aligner's metadata snapshot and the chunker's current
+       chunk size, for the next run to start from
+    '''
+    aligner.save_snapshot(snapshot_file)
+    save_chunk_size(chunk_size_path(snapshot_file), chunker.size)
+
+
 def run_data_pipeline(download_func, normalize_func, download_args,
-                      cache_file, connection_string, sample_size):
+                      cache_file, connection_string, sample_size,
+                      snapshot_file=None, insert_strategy='bisect',
+                      workers=1, batch_size=None, overlap=False,
+                      normalize_process=False, columnar=False):
     '''Executes all stages of the data processing pipeline.
 
        Downloads the data, according to the download arguments
        provided (generally from the command line), normalizes the data
        based on the network's format. The the fuction send the
        normalized rows through the align and insert phases of the
-       pipeline.
+       pipeline. If a snapshot_file is given, the database metadata
+       cached by the Align phase is loaded from and saved to it, and the
+       insert chunk size is carried over from run to run beside it (see
+       load_snapshot()).
+
+       If a batch_size is given, rows are pulled through the align and
+       insert phases in batches of at most that many rows, so that the
+       memory used does not grow with the size of the download. If
+       columnar is True, those batches are crmprtd.rowbatch.RowBatches
+       rather than lists of rows.
+
+       If overlap is True, the phases run concurrently (see
+       crmprtd.stages): download, normalize and align each run in their
+       own thread, connected by bounded queues, while insert runs in
+       this one. Align and insert then use separate database sessions,
+       and rows are aligned in batches of batch_size (or
+       OVERLAP_BATCH_SIZE) rows. If normalize_process is also True,
+       normalize runs in a separate process instead of a thread.
     '''
     download_iter = download_func(**download_args)
 
+    # Cache the download as it streams through, rather than holding it
     if cache_file:
-        download_iter, cache_iter = tee(download_iter)
-        with open(cache_file, 'w') as f:
-            for chunk in cache_iter:
-                f.write(chunk)
-
-    rows = [row for row in normalize_func(download_iter)]
+        download_iter = write_through(download_iter, cache_file)
+
+    if overlap:
+        download_iter = threaded(download_iter)
+        if normalize_process:
+            rows = in_process(normalize_func, download_iter)
+        else:
+            rows = threaded(normalize_func(download_iter), batch_size=256)
+        batch_size = batch_size or OVERLAP_BATCH_SIZE
+    else:
+        rows = normalize_func(download_iter)
 
-    engine = create_engine(connection_string)
+    engine = create_engine(connection_string, pool_size=pool_size(workers))
     Session = sessionmaker(engine)
     sesh = Session()
 
-    observations = [ob for ob in [align(sesh, row) for row in rows] if ob]
-    results = insert(sesh, observations, sample_size)
+    # Sessions can not be shared between threads
+    align_sesh = Session() if overlap else sesh
+    aligner = Aligner(align_sesh, records=(insert_strategy != 'bisect'))
+    chunker = AdaptiveChunker()
+    if snapshot_file:
+        chunker = load_snapshot(aligner, snapshot_file)
+    if columnar:
+        batches = RowBatch.batches(rows, batch_size)
+    else:
+        batches = batched(rows, batch_size)
+    observations = (aligner.align_batch(batch) for batch in batches)
+    if overlap:
+        observations = threaded(observations)
+    results = insert_batches(sesh, observations, insert_strategy, chunker,
+                             workers)
+    if snapshot_file:
+        save_snapshot(aligner, chunker, snapshot_file)
 
     log = logging.getLogger(__name__)
     log.info('Data insertion results',
-             extra={'results': results})
+             extra={'results': results,
+                    'metadata_cache': aligner.cache_stats()})
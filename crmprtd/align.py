@@ -8,13 +8,19 @@ Etc. The input is a stream tuples and the output is a stream of
 pycds.Obs objects. This phase is common to all networks.
 """
 
+import os
+import pickle
 import logging
-from sqlalchemy import and_
+import tempfile
+from collections import namedtuple, defaultdict
+from functools import lru_cache
+from sqlalchemy import and_, or_, tuple_
 from pint import UnitRegistry, UndefinedUnitError, DimensionalityError
 
 # local
 from pycds import Obs, History, Network, Variable, Station
 from crmprtd.db_exceptions import InsertionError
+from crmprtd.rowbatch import RowBatch, NO_TIME, from_epoch
 
 
 log = logging.getLogger(__name__)
@@ -33,45 +39,149 @@ for def_ in (
     ureg.define(def_)
 
 
-def closest_stns_within_threshold(sesh, network_name, lon, lat, threshold):
+# A lightweight, session-independent copy of a meta_vars row
+VariableInfo = namedtuple('VariableInfo', 'id name unit')
+
+# A compact aligned observation which can be used in place of pycds.Obs
+# by the insert strategies that do not go through the ORM
+ObsRecord = namedtuple('ObsRecord', 'history_id vars_id time datum')
+
+
+# Returned by Aligner.match_history() when an observation requires a new
+# station and history entry
+NEW_STATION = object()
+
+# Distance (in meters) within which an observation's location is
+# considered to match an existing history
+MATCH_THRESHOLD = 800
+
+# The spatial predicates below are written against this expression so
+# that this index can be used to answer them
+HISTORY_GEOGRAPHY_INDEX = """
+    CREATE INDEX IF NOT EXISTS meta_history_geography_idx
+    ON crmp.meta_history
+    USING gist (Geography(ST_Transform(the_geom, 4326)))
+"""
+
+
+def create_history_geography_index(sesh):
+    '''Creates the index used by closest_histories_within_threshold(), if
+       it does not exist (see the crmprtd_create_indexes script)
+    '''
+    sesh.execute(HISTORY_GEOGRAPHY_INDEX)
+    sesh.commit()
+
+
+def closest_histories_within_threshold(sesh, keys, threshold):
+    '''Finds the histories within `threshold` meters of each of a set of
+       locations with one spatial query
+
+       keys: an iterable of (network_name, native_id, lat, lon) tuples
+       threshold: distance in meters
+
+       Returns a dict mapping each key to the list of history_ids of
+       *all* the network's histories which lie within the threshold,
+       ordered from nearest to farthest.
+    '''
+    keys = list(keys)
     query_txt = """
-        WITH stns_in_thresh AS (
-            SELECT history_id, station_id, lat, lon, Geography(ST_Transform(the_geom,4326)) as p_existing,
-                Geography(ST_SetSRID(ST_MakePoint(:x, :y),4326)) as p_new
-            FROM crmp.meta_history
-            WHERE the_geom && ST_Buffer(Geography(ST_SetSRID(ST_MakePoint(:x, :y), 4326)),:thresh)
+        WITH points AS (
+            SELECT key_id, network_name,
+                Geography(ST_SetSRID(ST_MakePoint(lon, lat), 4326)) AS p_new
+            FROM unnest(CAST(:key_ids AS int[]),
+                        CAST(:network_names AS text[]),
+                        CAST(:lons AS float8[]),
+                        CAST(:lats AS float8[]))
+                AS keys(key_id, network_name, lon, lat)
         )
-        SELECT history_id, ST_Distance(p_existing,p_new) as dist
-        FROM stns_in_thresh
-        NATURAL JOIN crmp.meta_station
-        NATURAL JOIN crmp.meta_network
-        WHERE network_name = :network_name
-        ORDER BY dist
-""" # noqa
+        SELECT key_id, history_id,
+            ST_Distance(Geography(ST_Transform(the_geom, 4326)), p_new) AS dist
+        FROM points
+        JOIN crmp.meta_network USING (network_name)
+        JOIN crmp.meta_station USING (network_id)
+        JOIN crmp.meta_history USING (station_id)
+        WHERE ST_DWithin(Geography(ST_Transform(the_geom, 4326)), p_new,
+                         :thresh)
+        ORDER BY key_id, dist
+"""
     q = sesh.execute(query_txt, {
-        'x': lon,
-        'y': lat,
-        'thresh': threshold,
-        'network_name': network_name}
+        'key_ids': list(range(len(keys))),
+        'network_names': [network_name for network_name, _, _, _ in keys],
+        'lons': [float(lon) for _, _, _, lon in keys],
+        'lats': [float(lat) for _, _, lat, _ in keys],
+        'thresh': threshold}
     )
-    valid_hid = set([x[0] for x in q.fetchall()])
-    return valid_hid
+    nearby = {key: [] for key in keys}
+    for key_id, history_id, _ in q.fetchall():
+        nearby[keys[key_id]].append(history_id)
+    return nearby
+
+
+def closest_stns_within_threshold(sesh, network_name, lon, lat, threshold):
+    key = (network_name, None, lat, lon)
+    nearby = closest_histories_within_threshold(sesh, [key], threshold)
+    return set(nearby[key])
+
+
+class ConversionPlan(namedtuple('ConversionPlan', 'scale offset')):
+    '''An affine conversion between two units: scale * x + offset
+
+       Every unit conversion that pint supports (including the offset
+       temperature units) is affine, so pint only needs to be consulted
+       once per pair of units. Applying the plan is plain float
+       arithmetic.
+    '''
+
+    def convert(self, val):
+        return self.scale * val + self.offset
+
+    def convert_many(self, values):
+        return [self.scale * val + self.offset for val in values]
+
+
+@lru_cache(maxsize=None)
+def get_conversion_plan(src_unit, dst_unit):
+    '''Returns the ConversionPlan from src_unit to dst_unit or None if
+       the units are not convertible. Results (either way) are cached.
+    '''
+    def to_dst(val):
+        return Q_(val, ureg.parse_expression(src_unit)).to(dst_unit).magnitude
+
+    try:
+        offset = to_dst(0)
+        scale = to_dst(1) - offset
+    except (UndefinedUnitError, DimensionalityError) as e:
+        log.error('Unable to convert units',
+                  extra={'src_unit': src_unit,
+                         'dst_unit': dst_unit,
+                         'exception': e})
+        return None
+    return ConversionPlan(scale, offset)
 
 
 def convert_unit(val, src_unit, dst_unit):
     if src_unit != dst_unit:
-        try:
-            val = Q_(val, ureg.parse_expression(src_unit))  # src
-            val = val.to(dst_unit).magnitude  # dest
-        except (UndefinedUnitError, DimensionalityError) as e:
-            log.error('Unable to convert units',
-                      extra={'src_unit': src_unit,
-                             'dst_unit': dst_unit,
-                             'exception': e})
+        plan = get_conversion_plan(src_unit, dst_unit)
+        if plan is None:
             return None
+        val = plan.convert(val)
     return val
 
 
+def convert_units(values, src_unit, dst_unit):
+    '''Converts a whole sequence of values from src_unit to dst_unit
+
+       Returns a list of the converted values or None if the units
+       are not convertible
+    '''
+    if src_unit == dst_unit:
+        return list(values)
+    plan = get_conversion_plan(src_unit, dst_unit)
+    if plan is None:
+        return None
+    return plan.convert_many(values)
+
+
 def unit_check(val, unit_obs, unit_db):
     if unit_db is None:
         return None
@@ -98,59 +208,58 @@ def find_active_history(histories):
         return None
 
 
-def find_nearest_history(sesh, network_name, native_id, lat, lon, histories):
-    close_stns = closest_stns_within_threshold(sesh, network_name,
-                                               lon, lat, 800)
-
-    if len(close_stns) == 0:
-        return create_station_and_history_entry(sesh, network_name,
-                                                native_id, lat, lon)
+def create_stations_and_histories(sesh, entries):
+    '''Creates a station and a history entry for each of `entries`
+       with two bulk INSERT ... RETURNING statements and commits them
 
-    for id in close_stns:
-        for history in histories:
-            if id == history.id:
-                log.debug('Matched history',
-                          extra={'station_name': history.station_name})
-                return history
-
-
-def match_station(sesh, network_name, native_id, lat, lon, histories):
-    if lat and lon:
-        return find_nearest_history(sesh, network_name, native_id,
-                                    lat, lon, histories)
-    else:
-        return find_active_history(histories)
-
-
-def create_station_and_history_entry(sesh, network_name, native_id, lat, lon,
-                                     diagnostic=False):
-    network = sesh.query(Network).filter(
-        Network.name == network_name)
+       entries: list of (network_id, native_id, lat, lon) tuples
 
-    network = network.first()
-    stn = Station(native_id=native_id, network=network)
+       Returns the ids of the new histories, in the order of `entries`
 
-    log.info('Created new station entry',
-             extra={'native_id': stn.native_id, 'network_name': network.name})
-
-    hist = History(station=stn,
-                   lat=lat,
-                   lon=lon)
-
-    log.warning('Created new history entry',
-                extra={'history': hist.id, 'network_name': network_name,
-                       'native_id': stn.native_id, 'lat': lat, 'lon': lon})
+       RETURNING does not guarantee the order of its rows, so the new
+       ids are matched to `entries` by key rather than by position.
+       Entries with the same (network_id, native_id) get stations which
+       are indistinguishable, so any one of them will do for each.
+    '''
+    stations = Station.__table__
+    histories = History.__table__
     try:
-        sesh.add(stn)
-        sesh.add(hist)
+        q = sesh.execute(
+            stations.insert().values([
+                {'network_id': network_id, 'native_id': native_id}
+                for network_id, native_id, _, _ in entries
+            ]).returning(stations.c.station_id, stations.c.network_id,
+                         stations.c.native_id)
+        )
+        new_stations = defaultdict(list)
+        for station_id, network_id, native_id in q:
+            new_stations[(network_id, native_id)].append(station_id)
+        station_ids = [new_stations[(network_id, native_id)].pop()
+                       for network_id, native_id, _, _ in entries]
+
+        q = sesh.execute(
+            histories.insert().values([
+                {'station_id': station_id, 'lat': lat, 'lon': lon}
+                for station_id, (_, _, lat, lon) in zip(station_ids, entries)
+            ]).returning(histories.c.history_id, histories.c.station_id)
+        )
+        new_histories = {station_id: history_id for history_id, station_id
+                         in q}
+        history_ids = [new_histories[station_id]
+                       for station_id in station_ids]
     except Exception as e:
         log.warning('Unable to insert new stn/hist entries',
-                    extra={'stn': stn, 'hist': hist, 'exception': e})
+                    extra={'entries': entries, 'exception': e})
         sesh.rollback()
-        raise InsertionError(native_id=stn.id, hid=hist.id, e=e)
+        raise InsertionError(entries=entries, e=e)
     else:
         sesh.commit()
-    return hist
+
+    for history_id, (_, native_id, lat, lon) in zip(history_ids, entries):
+        log.warning('Created new history entry',
+                    extra={'history': history_id, 'native_id': native_id,
+                           'lat': lat, 'lon': lon})
+    return history_ids
 
 
 def get_variable(sesh, network_name, variable_name):
@@ -165,25 +274,20 @@ def get_variable(sesh, network_name, variable_name):
 
 
 def get_history(sesh, network_name, native_id, lat, lon, diagnostic=False):
-    log.debug("Searching for native_id = %s", native_id)
-    histories = sesh.query(History).join(Station).join(Network).filter(and_(
-        Network.name == network_name,
-        Station.native_id == native_id))
-
-    if histories.count() == 0:
-        log.debug("Cound not find native_id %s", native_id)
-        if diagnostic:
-            log.debug("In diagnostic mode. Returning from get_history")
-            return
-        return create_station_and_history_entry(sesh, network_name, native_id,
-                                                lat, lon)
-    elif histories.count() == 1:
-        log.debug("Found exactly one matching history_id")
-        return histories.one_or_none()
-    elif histories.count() >= 2:
-        log.debug("Found multiple history entries. Searching for match.")
-        return match_station(sesh, network_name, native_id, lat, lon,
-                             histories)
+    '''Returns the History matching a station and location, creating a
+       new station and history if there is none (unless in diagnostic
+       mode). Matching is done by the session's Aligner (see
+       get_aligner()).
+    '''
+    aligner = get_aligner(sesh, diagnostic)
+    if not aligner.is_network(network_name):
+        return None
+    key = (network_name, native_id, lat, lon)
+    aligner.resolve_histories({key})
+    history_id = aligner.histories[key]
+    if not history_id:
+        return None
+    return sesh.query(History).get(history_id)
 
 
 def is_network(sesh, network_name):
@@ -192,57 +296,547 @@ def is_network(sesh, network_name):
     return network.count() != 0
 
 
+# Bump this whenever the contents of metadata snapshots change
+SNAPSHOT_FORMAT = 1
+
+
+def metadata_version(sesh):
+    '''Returns a cheap summary of the metadata tables which changes
+       whenever rows are added to (or deleted from) them
+    '''
+    query_txt = """
+        SELECT
+            (SELECT ARRAY[count(*), max(network_id)]
+             FROM crmp.meta_network) AS networks,
+            (SELECT ARRAY[count(*), max(vars_id)]
+             FROM crmp.meta_vars) AS variables,
+            (SELECT ARRAY[count(*), max(history_id)]
+             FROM crmp.meta_history) AS histories,
+            (SELECT max(edate) FROM crmp.meta_history) AS max_edate
+"""
+    networks, variables, histories, max_edate = sesh.execute(
+        query_txt).fetchone()
+    return {'database': repr(sesh.get_bind().url),
+            'networks': tuple(networks),
+            'variables': tuple(variables),
+            'histories': tuple(histories),
+            'max_edate': max_edate}
+
+
 def has_required_information(obs_tuple):
     return obs_tuple.network_name is not None and obs_tuple.time is not None \
         and obs_tuple.val is not None and obs_tuple.variable_name is not None
 
 
-def align(sesh, obs_tuple, diagnostic=False):
-    # Without these items an Obs object cannot be produced
-    if not has_required_information(obs_tuple):
-        log.debug('Observation missing critical information',
-                  extra={'network_name': obs_tuple.network_name,
-                         'time': obs_tuple.time,
-                         'val': obs_tuple.val,
-                         'variable_name': obs_tuple.variable_name})
-        return None
+def history_key(obs_tuple):
+    '''Returns the attributes of an observation that determine its history
+    '''
+    return (obs_tuple.network_name, obs_tuple.station_id,
+            obs_tuple.lat, obs_tuple.lon)
+
+
+def get_aligner(sesh, diagnostic=False, records=False):
+    '''Returns the Aligner kept for a session (and the given options),
+       creating it on first use
+
+       The Aligner lives in the session's info dict, so that its cache
+       lasts as long as the session does.
+    '''
+    aligners = sesh.info.setdefault('crmprtd.aligners', {})
+    key = (diagnostic, records)
+    if key not in aligners:
+        aligners[key] = Aligner(sesh, diagnostic, records)
+    return aligners[key]
+
+
+def align(sesh, obs_tuple, diagnostic=False, records=False):
+    '''Aligns a single row with the session's Aligner (see
+       get_aligner()), so that the metadata is only loaded once per
+       session however many rows are aligned. Prefer using an Aligner
+       directly, with align_batch().
+    '''
+    return get_aligner(sesh, diagnostic, records).align(obs_tuple)
+
+
+def align_batch(sesh, rows, diagnostic=False, records=False):
+    return get_aligner(sesh, diagnostic, records).align_batch(rows)
+
+
+class Aligner(object):
+    '''Run-scoped cache of the database metadata required by the Align phase
+
+       The network and variable tables are small and rarely change, so
+       rather than querying them for every observation, they are
+       loaded once (on first use) and all subsequent lookups, positive
+       or negative, are answered from memory. Lookup hits and misses
+       are counted so that they can be reported at the end of a run.
+
+       Histories are resolved per distinct (network_name, station_id,
+       lat, lon) key rather than per observation. align_batch()
+       resolves every new key of a batch with a single query and the
+       results are kept for the remainder of the run.
+
+       All of the cached metadata can be saved to a snapshot file at
+       the end of a run and loaded at the start of the next one (see
+       load_snapshot()).
+
+       If records is True, aligned observations are emitted as compact
+       ObsRecord tuples instead of pycds.Obs objects.
+    '''
+
+    def __init__(self, sesh, diagnostic=False, records=False):
+        self.sesh = sesh
+        self.diagnostic = diagnostic
+        self.obs_class = ObsRecord if records else Obs
+        self.networks = None
+        self.variables = None
+        self.histories = {}
+        self.hits = 0
+        self.misses = 0
+        self.version = None
+
+    def load(self):
+        log.debug('Loading network and variable metadata')
+        self.networks = {
+            name: id_ for id_, name in
+            self.sesh.query(Network.id, Network.name)
+        }
+        q = self.sesh.query(Network.name, Variable.id, Variable.name,
+                            Variable.unit).join(Variable.network)
+        self.variables = {
+            (network_name, name): VariableInfo(id_, name, unit)
+            for network_name, id_, name, unit in q
+        }
+        log.debug('Loaded metadata',
+                  extra={'num_networks': len(self.networks),
+                         'num_variables': len(self.variables)})
+
+    def _count(self, found):
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    def is_network(self, network_name):
+        if self.networks is None:
+            self.load()
+        return self._count(network_name in self.networks)
+
+    def get_variable(self, network_name, variable_name):
+        if self.variables is None:
+            self.load()
+        variable = self.variables.get((network_name, variable_name))
+        self._count(variable is not None)
+        return variable
+
+    def cache_stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def match_history(self, key, histories, nearby=None):
+        '''Chooses the history for `key` among all of the histories of
+           its station
+
+           nearby: the histories of the network close to the key's
+           location as found by closest_histories_within_threshold()
+           (only required for stations with multiple histories)
+
+           Returns a History, None if there is no match, or NEW_STATION
+           if a new station and history should be created for the key
+        '''
+        network_name, native_id, lat, lon = key
+        if len(histories) == 0:
+            log.debug("Cound not find native_id %s", native_id)
+            if self.diagnostic:
+                log.debug("In diagnostic mode. Not creating a new station")
+                return None
+            return NEW_STATION
+        elif len(histories) == 1:
+            log.debug("Found exactly one matching history_id")
+            return histories[0]
 
-    if not is_network(sesh, obs_tuple.network_name):
-        log.error('Network does not exist in db',
-                  extra={'network_name': obs_tuple.network_name})
-        return None
+        log.debug("Found multiple history entries. Searching for match.")
+        if not (lat and lon):
+            return find_active_history(histories)
 
-    history = get_history(sesh, obs_tuple.network_name, obs_tuple.station_id,
-                          obs_tuple.lat, obs_tuple.lon, diagnostic)
+        if not nearby:
+            return None if self.diagnostic else NEW_STATION
 
-    if not history:
-        log.warning('Could not find history match',
-                    extra={'network_name': obs_tuple.network_name,
-                           'native_id': obs_tuple.station_id})
-        return None
+        histories = {history.id: history for history in histories}
+        for history_id in nearby:
+            if history_id in histories:
+                history = histories[history_id]
+                log.debug('Matched history',
+                          extra={'station_name': history.station_name})
+                return history
 
-    variable = get_variable(sesh, obs_tuple.network_name,
-                            obs_tuple.variable_name)
+    def fetch_histories(self, stations):
+        '''Fetches all of the histories of a set of (network_name,
+           native_id) stations with one query
+        '''
+        # A NULL native_id never compares equal in IN (...), so stations
+        # without one are matched with IS NULL instead
+        ids = [station for station in stations if station[1] is not None]
+        no_ids = {network_name for network_name, native_id in stations
+                  if native_id is None}
+        conditions = []
+        if ids:
+            conditions.append(
+                tuple_(Network.name, Station.native_id).in_(ids))
+        if no_ids:
+            conditions.append(and_(Network.name.in_(no_ids),
+                                   Station.native_id.is_(None)))
+        if not conditions:
+            return defaultdict(list)
+
+        q = self.sesh.query(History, Network.name, Station.native_id)\
+            .select_from(History)\
+            .join(History.station).join(Station.network)\
+            .filter(or_(*conditions))
+
+        histories = defaultdict(list)
+        for history, network_name, native_id in q:
+            histories[(network_name, native_id)].append(history)
+        return histories
+
+    def resolve_histories(self, keys):
+        '''Resolves the history ids of all of the given history keys
+
+           All of the histories of every station referenced by the
+           unresolved keys are fetched with one query. Keys are then
+           matched to a history in memory, so that the cost depends on
+           the number of distinct stations rather than on the number of
+           observations. Any new stations that are required are created
+           together at the end.
+        '''
+        pending = {key for key in keys if key not in self.histories}
+        if not pending:
+            return
 
-    # Necessary attributes for Obs object
-    if not variable:
-        log.debug('Variable "%s" from network "%s" is not tracked by crmp',
-                  obs_tuple.variable_name, obs_tuple.network_name)
-        return None
+        new_stations = self.match_keys(pending)
+        if new_stations:
+            self.create_histories(new_stations)
+
+    def match_keys(self, keys):
+        '''Matches history keys to the existing histories of their
+           stations, and records the history id of each key that matches
+
+           Returns a dict mapping each station which must be created to
+           the list of keys which it will resolve (see
+           create_histories())
+        '''
+        stations = {(network_name, native_id)
+                    for network_name, native_id, _, _ in keys}
+        log.debug('Resolving histories', extra={'num_keys': len(keys),
+                                                'num_stations': len(stations)})
+        candidates = self.fetch_histories(stations)
+
+        # Stations with several histories are disambiguated by location
+        # with one spatial query for all of the batch's keys
+        located = [
+            key for key in keys
+            if len(candidates[key[:2]]) > 1 and key[2] and key[3]
+        ]
+        nearby = closest_histories_within_threshold(
+            self.sesh, located, MATCH_THRESHOLD) if located else {}
+
+        new_stations = defaultdict(list)
+        for key in keys:
+            history = self.match_history(key, candidates[key[:2]],
+                                         nearby.get(key))
+            if history is NEW_STATION:
+                # An unknown native_id gets a single new station no matter
+                # how many locations it is reported at
+                station = key if candidates[key[:2]] else key[:2]
+                new_stations[station].append(key)
+            else:
+                self.histories[key] = history.id if history else None
+        return new_stations
+
+    def create_histories(self, new_stations):
+        '''Creates the stations and histories required by a batch in one
+           transaction
+
+           new_stations: dict mapping each station to be created to the
+           list of history keys which it will resolve. A station is
+           either a (network_name, native_id) pair, for a native_id with
+           no histories, or a full history key.
+        '''
+        # Concurrent runs for the same network could otherwise create the
+        # same station twice. Hold a per-network advisory lock until the
+        # transaction ends and then match all of the keys again, against
+        # any stations and histories created while waiting for it.
+        for network_name in sorted({station[0] for station in new_stations}):
+            self.sesh.execute('SELECT pg_advisory_xact_lock(hashtext(:lock))',
+                              {'lock': 'crmprtd.align.' + network_name})
+
+        keys = [key for keys in new_stations.values() for key in keys]
+        new_stations = self.match_keys(keys)
+        matched = len(keys) - sum(map(len, new_stations.values()))
+        if matched:
+            log.debug('Histories were created by another process',
+                      extra={'num_keys': matched})
+
+        if not new_stations:
+            self.sesh.commit()
+            return
 
-    datum = unit_check(obs_tuple.val, obs_tuple.unit, variable.unit)
-    if datum is None:
-        log.debug('Unable to confirm data units',
-                  extra={'unit_obs': obs_tuple.unit,
-                         'unit_db': variable.unit,
-                         'data': obs_tuple.val,
-                         'network_name': obs_tuple.network_name})
-        return None
+        entries = []
+        for keys in new_stations.values():
+            network_name, native_id, lat, lon = keys[0]
+            log.info('Created new station entry',
+                     extra={'native_id': native_id,
+                            'network_name': network_name})
+            entries.append((self.networks[network_name], native_id, lat, lon))
+
+        history_ids = create_stations_and_histories(self.sesh, entries)
+        for keys, history_id in zip(new_stations.values(), history_ids):
+            for key in keys:
+                self.histories[key] = history_id
+
+    def load_snapshot(self, path):
+        '''Warms up the cache from a snapshot saved by a previous run
+
+           The snapshot is only used if it was taken from the same
+           database. Networks and variables are reused if their tables
+           have not changed. Resolved histories are reused if
+           meta_history has not changed, or if histories have only been
+           added since, in which case the keys of the stations that
+           gained histories are dropped.
+        '''
+        self.version = metadata_version(self.sesh)
+        try:
+            with open(path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            log.info('No metadata snapshot found', extra={'path': path})
+            return
+        except Exception as e:
+            log.warning('Unable to load metadata snapshot',
+                        extra={'path': path, 'exception': e})
+            return
+
+        old = snapshot.get('version', {})
+        if snapshot.get('format') != SNAPSHOT_FORMAT or \
+                old.get('database') != self.version['database']:
+            log.info('Ignoring incompatible metadata snapshot',
+                     extra={'path': path})
+            return
+
+        if old['networks'] == self.version['networks'] and \
+                old['variables'] == self.version['variables']:
+            self.networks = snapshot['networks']
+            self.variables = snapshot['variables']
+
+        histories = snapshot['histories']
+        (old_count, old_max), (count, max_) = \
+            old['histories'], self.version['histories']
+        if old['histories'] == self.version['histories'] and \
+                old['max_edate'] == self.version['max_edate']:
+            self.histories.update(histories)
+        elif count - old_count == (max_ or 0) - (old_max or 0) > 0 and \
+                old['max_edate'] == self.version['max_edate']:
+            q = self.sesh.query(Network.name, Station.native_id)\
+                .select_from(History)\
+                .join(History.station).join(Station.network)\
+                .filter(History.id > (old_max or 0))
+            changed = set(q)
+            self.histories.update({
+                key: history_id for key, history_id in histories.items()
+                if key[:2] not in changed
+            })
+            log.info('Refreshed metadata snapshot',
+                     extra={'num_changed_stations': len(changed)})
+        log.info('Loaded metadata snapshot',
+                 extra={'path': path,
+                        'metadata_reused': self.networks is not None,
+                        'num_histories': len(self.histories)})
+
+    def save_snapshot(self, path):
+        '''Atomically writes the cached metadata to `path`
+        '''
+        if self.version is None:
+            self.version = metadata_version(self.sesh)
+        if self.networks is None:
+            self.load()
+        snapshot = {'format': SNAPSHOT_FORMAT,
+                    'version': self.version,
+                    'networks': self.networks,
+                    'variables': self.variables,
+                    'histories': self.histories}
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        log.info('Saved metadata snapshot', extra={'path': path})
+
+    def align(self, obs_tuple):
+        observations = self.align_batch([obs_tuple])
+        return observations[0] if observations else None
+
+    def align_batch(self, rows):
+        '''Aligns a batch of observation tuples (or a RowBatch),
+           returning a list of pycds.Obs objects (or ObsRecords) for
+           those that could be aligned
+        '''
+        if isinstance(rows, RowBatch):
+            return self.align_row_batch(rows)
+        rows = [row for row in rows if self.is_valid(row)]
+        self.resolve_histories({history_key(row) for row in rows})
+        return [ob for ob in map(self.make_obs, rows) if ob]
+
+    def align_row_batch(self, batch):
+        '''Aligns a RowBatch without materializing its rows
+
+           Rows are grouped by their dictionary codes for the history
+           key, variable and unit, so that validation, matching and the
+           choice of unit conversion happen once per group rather than
+           once per row, and the values of each group are converted
+           together.
+        '''
+        columns = (batch.network_name, batch.station_id, batch.lat,
+                   batch.lon, batch.variable_name, batch.unit)
+        groups = {}
+        row_groups = []
+        # The indices of the rows in each group
+        members = []
+        for i, codes in enumerate(zip(*(c.codes for c in columns))):
+            # Without a time and value an Obs object cannot be produced
+            if batch.times[i] == NO_TIME or batch.val_missing[i]:
+                row_groups.append(None)
+                continue
+            group = groups.setdefault(codes, len(groups))
+            if group == len(members):
+                members.append([])
+            members[group].append(i)
+            row_groups.append(group)
+
+        # The (network_name, station_id, lat, lon, variable_name, unit)
+        # of each group
+        samples = [None] * len(groups)
+        for codes, group in groups.items():
+            samples[group] = tuple(column.values[code]
+                                   for column, code in zip(columns, codes))
+
+        valid = []
+        for network_name, _, _, _, variable_name, _ in samples:
+            if network_name is None or variable_name is None:
+                valid.append(False)
+            elif not self.is_network(network_name):
+                log.error('Network does not exist in db',
+                          extra={'network_name': network_name})
+                valid.append(False)
+            else:
+                valid.append(True)
+        self.resolve_histories({sample[:4] for sample, ok
+                                in zip(samples, valid) if ok})
+
+        # For each group, the history and variable ids and the plan
+        # converting values into the variable's units (or None)
+        targets = []
+        for (network_name, station_id, lat, lon, variable_name,
+             unit), ok in zip(samples, valid):
+            if not ok:
+                targets.append(None)
+                continue
+            history_id = self.histories[(network_name, station_id, lat, lon)]
+            if not history_id:
+                log.warning('Could not find history match',
+                            extra={'network_name': network_name,
+                                   'native_id': station_id})
+                targets.append(None)
+                continue
+            variable = self.get_variable(network_name, variable_name)
+            if not variable or variable.unit is None:
+                log.debug('Variable "%s" from network "%s" is not tracked '
+                          'by crmp', variable_name, network_name)
+                targets.append(None)
+                continue
+            plan = None
+            if unit is not None and unit != variable.unit:
+                plan = get_conversion_plan(unit, variable.unit)
+                if plan is None:
+                    targets.append(None)
+                    continue
+            targets.append((history_id, variable.id, plan))
+
+        # Convert the values of each group all at once
+        datums = {}
+        for rows, target in zip(members, targets):
+            if target is None:
+                continue
+            vals = [batch.vals[i] for i in rows]
+            if target[2] is not None:
+                vals = target[2].convert_many(vals)
+            datums.update(zip(rows, vals))
+
+        observations = []
+        times = {}
+        for i, group in enumerate(row_groups):
+            if group is None or targets[group] is None:
+                continue
+            t = batch.times[i]
+            if t not in times:
+                times[t] = from_epoch(t)
+            history_id, vars_id, _ = targets[group]
+            observations.append(self.obs_class(
+                history_id=history_id, time=times[t],
+                datum=datums[i], vars_id=vars_id))
+        return observations
+
+    def is_valid(self, obs_tuple):
+        # Without these items an Obs object cannot be produced
+        if not has_required_information(obs_tuple):
+            log.debug('Observation missing critical information',
+                      extra={'network_name': obs_tuple.network_name,
+                             'time': obs_tuple.time,
+                             'val': obs_tuple.val,
+                             'variable_name': obs_tuple.variable_name})
+            return False
+
+        if not self.is_network(obs_tuple.network_name):
+            log.error('Network does not exist in db',
+                      extra={'network_name': obs_tuple.network_name})
+            return False
+
+        return True
+
+    def make_obs(self, obs_tuple):
+        history_id = self.histories[history_key(obs_tuple)]
+
+        if not history_id:
+            log.warning('Could not find history match',
+                        extra={'network_name': obs_tuple.network_name,
+                               'native_id': obs_tuple.station_id})
+            return None
+
+        variable = self.get_variable(obs_tuple.network_name,
+                                     obs_tuple.variable_name)
+
+        # Necessary attributes for Obs object
+        if not variable:
+            log.debug('Variable "%s" from network "%s" is not tracked by crmp',
+                      obs_tuple.variable_name, obs_tuple.network_name)
+            return None
+
+        datum = unit_check(obs_tuple.val, obs_tuple.unit, variable.unit)
+        if datum is None:
+            log.debug('Unable to confirm data units',
+                      extra={'unit_obs': obs_tuple.unit,
+                             'unit_db': variable.unit,
+                             'data': obs_tuple.val,
+                             'network_name': obs_tuple.network_name})
+            return None
 
-    # Note: We are very specifically creating the Obs object here using the ids
-    # to avoid SQLAlchemy adding this object to the session as part of its
-    # cascading backref behaviour https://goo.gl/Lchhv6
-    return Obs(history_id=history.id,
-               time=obs_tuple.time,
-               datum=datum,
-               vars_id=variable.id)
+        # Note: We are very specifically creating the Obs object here using
+        # the ids to avoid SQLAlchemy adding this object to the session as
+        # part of its cascading backref behaviour https://goo.gl/Lchhv6
+        return self.obs_class(history_id=history_id,
+                              time=obs_tuple.time,
+                              datum=datum,
+                              vars_id=variable.id)
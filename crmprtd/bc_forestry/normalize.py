@@ -1,6 +1,14 @@
-from crmprtd.swob_ml import normalize as normalize_swob
+from crmprtd.swob_ml import normalize as normalize_swob, \
+    normalize_batches as normalize_swob_batches
 
 
-def normalize(file_stream):
+def normalize(file_stream, workers=None, ordered=True):
     yield from normalize_swob(file_stream, 'FLNRO-WMB',
-                              station_id_attr='stn_id')
+                              station_id_attr='stn_id',
+                              workers=workers, ordered=ordered)
+
+
+def normalize_batches(file_stream, batch_size=None):
+    return normalize_swob_batches(file_stream, 'FLNRO-WMB',
+                                  station_id_attr='stn_id',
+                                  batch_size=batch_size)
@@ -1,11 +1,20 @@
-from crmprtd.swob_ml import normalize as normalize_swob
+from crmprtd.swob_ml import normalize as normalize_swob, \
+    normalize_batches as normalize_swob_batches
 
 
 def strip_stn_prefix(stn_id):
     return stn_id.replace('BC_TRAN_', '')
 
 
-def normalize(file_stream):
+def normalize(file_stream, workers=None, ordered=True):
     yield from normalize_swob(file_stream, 'MoTIe',
                               station_id_attr='stn_id',
-                              station_id_xform=strip_stn_prefix)
+                              station_id_xform=strip_stn_prefix,
+                              workers=workers, ordered=ordered)
+
+
+def normalize_batches(file_stream, batch_size=None):
+    return normalize_swob_batches(file_stream, 'MoTIe',
+                                  station_id_attr='stn_id',
+                                  station_id_xform=strip_stn_prefix,
+                                  batch_size=batch_size)
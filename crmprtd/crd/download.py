@@ -57,7 +57,7 @@ def make_url(client_id, sdate=None, edate=None):
 def download(client_id, start_date, end_date):  # pragma: no cover
     url = make_url(client_id, start_date, end_date)
     try:
-        crmprtd.download.https_download(url, 'https', log)
+        crmprtd.download.https_download(url, log=log)
 
     except IOError:
         log.exception("Unable to download or open JSON data")
@@ -1,51 +1,157 @@
 # Standard library
 import json
+import codecs
 
-# Installed libraries
-import pytz
 import logging
-from datetime import datetime
 
 # Local
 from crmprtd import Row
+from crmprtd.timeparse import parse_local
 
 
 log = logging.getLogger(__name__)
 
+# Size of the reads made from the response
+CHUNK_SIZE = 2 ** 16
 
-def normalize(stream):
-    log.info('Starting CRD data normalization')
 
-    tz = pytz.timezone('Canada/Pacific')
+class JSONStream(object):
+    '''Reads JSON values one by one from a binary stream, so that the
+       elements of a large array can be decoded without reading all of
+       it into memory
+    '''
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        # Skips a byte order mark, as json.loads() does
+        self.decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.json = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        self.eof = not chunk
+        # Drop what has already been consumed
+        self.buf = self.buf[self.pos:] + self.decoder.decode(chunk, self.eof)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        '''Returns the next non-whitespace character (or '' at the end)'''
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf) or not self.read_more():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('Expected one of {!r} at {!r}'.format(
+                chars, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+        return c
+
+    def value(self):
+        '''Decodes the next complete JSON value'''
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buf, self.pos)
+                # A number could continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+    def items(self):
+        '''Yields the (key, stream) pairs of an object. The value of each
+           key must be consumed from the stream before the next pair.
+        '''
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key, self
+            if self.expect(',}') == '}':
+                return
+
+    def elements(self):
+        '''Yields the elements of an array one at a time'''
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+
+def normalize(stream, chunk_size=CHUNK_SIZE):
+    '''Normalizes a CRD web service response incrementally
+
+       Rows are yielded record by record as the DATA array is parsed.
+       This relies on the HEADER (and its units) coming before the DATA,
+       as the service sends them. Should the DATA come first, its records
+       are kept until the HEADER has been read.
+    '''
+    log.info('Starting CRD data normalization')
 
-    data = json.load(stream)
+    units = None
+    pending = []
+    for key, doc in JSONStream(stream, chunk_size).items():
+        if key == "HEADER":
+            units = doc.value()["_units"]
+            var_names = [unit.replace("Unit", "") for unit in units.keys()]
+            log.debug("Found variables %s", var_names)
+            for record in pending:
+                yield from normalize_record(record, units, var_names)
+            pending = []
+        elif key == "DATA":
+            for record in doc.elements():
+                if units is None:
+                    pending.append(record)
+                else:
+                    yield from normalize_record(record, units, var_names)
+        else:
+            doc.value()
 
-    units = data["HEADER"]["_units"]
-    var_names = [unit.replace("Unit", "") for unit in units.keys()]
-    log.debug("Found variables %s", var_names)
+    if units is None:
+        raise KeyError("HEADER")
 
-    for record in data["DATA"]:
 
-        # Timezone information isn't provided by CRD, but the
-        # observations appear to be in local time. The max time
-        # value found in a request is the most recent hour local
-        # time. Hopefully assuming this will suffice.
-        date = datetime.strptime(record["DateTimeString"], "%Y%m%d%H%M%S")
-        date = tz.localize(date).astimezone(pytz.utc)
+def normalize_record(record, units, var_names):
+    # Timezone information isn't provided by CRD, but the
+    # observations appear to be in local time. The max time
+    # value found in a request is the most recent hour local
+    # time. Hopefully assuming this will suffice.
+    date = parse_local(record["DateTimeString"], "%Y%m%d%H%M%S")
 
-        for var_name in var_names:
+    for var_name in var_names:
 
-            # CRD uses -9999 and null for missing values. Skip these.
-            # See page 2 here: https://tinyurl.com/quczs93
-            val = record[var_name]
-            if val is None or val == -9999:
-                continue
+        # CRD uses -9999 and null for missing values. Skip these.
+        # See page 2 here: https://tinyurl.com/quczs93
+        val = record[var_name]
+        if val is None or val == -9999:
+            continue
 
-            yield Row(time=date,
-                      val=val,
-                      variable_name=var_name,
-                      unit=units[f"{var_name}Unit"],
-                      network_name="CRD",
-                      station_id=record["StationName"],
-                      lat=None,
-                      lon=None)
+        yield Row(time=date,
+                  val=val,
+                  variable_name=var_name,
+                  unit=units[f"{var_name}Unit"],
+                  network_name="CRD",
+                  station_id=record["StationName"],
+                  lat=None,
+                  lon=None)
@@ -0,0 +1,33 @@
+import logging
+from argparse import ArgumentParser
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from crmprtd.align import create_history_geography_index
+from crmprtd import logging_args, setup_logging
+
+
+def main():
+    '''Creates the database indexes that the Align phase relies on to
+       match stations by location quickly, if they do not already exist.
+       Only needs to be run once per database.
+    '''
+    parser = ArgumentParser(description=main.__doc__)
+    parser.add_argument('-c', '--connection_string',
+                        help='PostgreSQL connection string',
+                        required=True)
+    parser = logging_args(parser)
+    args = parser.parse_args()
+
+    setup_logging(args.log_conf, args.log_filename, args.error_email,
+                  args.log_level, 'crmprtd')
+    log = logging.getLogger('crmprtd')
+
+    sesh = sessionmaker(create_engine(args.connection_string))()
+    create_history_geography_index(sesh)
+    log.info('Created the history geography index')
+
+
+if __name__ == "__main__":
+    main()
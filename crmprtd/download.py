@@ -3,12 +3,22 @@ import time
 import ftplib
 import logging
 import csv
+import warnings
+import threading
+import urllib.parse
 from functools import wraps
 
 import yaml
 import requests
 
 
+# Defaults for the shared HTTP session (see configure_session())
+POOL_SIZE = 10
+RETRIES = 3
+# Seconds to wait to connect and for each read (None waits forever)
+TIMEOUT = None
+
+
 def retry(ExceptionToCheck, tries=4, delay=3, backoff=2, logger=None):
     """Retry calling the decorated function using an exponential backoff.
 
@@ -128,34 +138,144 @@ def extract_auth(username, password, auth_yaml, auth_key):
         }
 
 
-def https_download(url, scheme='https', log=None, auth=None, payload={}):
+class SessionPool(object):
+    '''Keep-alive HTTP connections which are reused between requests
+
+       Connections to up to pool_size hosts are kept, with up to
+       pool_size connections to each (e.g. for concurrent requests from
+       several threads). Failed connections are retried up to retries
+       times, and timeout (in seconds, or a (connect, read) tuple) is
+       the default timeout of each request.
+
+       requests.Session is not thread-safe, so each thread gets its own
+       Session, and all of them share one HTTPAdapter (and so one pool
+       of connections). Cookies are therefore not shared between
+       threads.
+    '''
+
+    def __init__(self, pool_size=POOL_SIZE, retries=RETRIES,
+                 timeout=TIMEOUT):
+        self.timeout = timeout
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=retries)
+        self.local = threading.local()
+        self.sessions = []
+        self.lock = threading.Lock()
+
+        # Keep the counts of the connection pools which are evicted (to
+        # make room for other hosts) or closed, for stats()
+        self.closed_stats = {'opened': 0, 'requests': 0}
+        pools = self.adapter.poolmanager.pools
+        dispose = pools.dispose_func
+
+        def count_and_dispose(pool):
+            with self.lock:
+                self.closed_stats['opened'] += pool.num_connections
+                self.closed_stats['requests'] += pool.num_requests
+            if dispose:
+                dispose(pool)
+        pools.dispose_func = count_and_dispose
+
+    @property
+    def session(self):
+        '''The calling thread's Session'''
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self.adapter)
+            session.mount('http://', self.adapter)
+            self.local.session = session
+            with self.lock:
+                self.sessions.append(session)
+        return session
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def stats(self):
+        '''Return the number of connections opened and of requests
+           which reused an open connection
+        '''
+        pools = self.adapter.poolmanager.pools
+        with self.lock:
+            opened = self.closed_stats['opened']
+            requests_made = self.closed_stats['requests']
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                requests_made += pool.num_requests
+        return {'opened': opened, 'reused': max(requests_made - opened, 0)}
+
+    def close(self):
+        with self.lock:
+            sessions, self.sessions = self.sessions, []
+        for session in sessions:
+            session.close()
+        self.adapter.close()
+
+
+_session_pool = None
+_session_lock = threading.Lock()
+
+
+def configure_session(pool_size=POOL_SIZE, retries=RETRIES, timeout=TIMEOUT):
+    '''Replace the session shared by the download functions of this
+       process with one configured as given (see SessionPool)
+    '''
+    global _session_pool
+    with _session_lock:
+        if _session_pool is not None:
+            _session_pool.close()
+        _session_pool = SessionPool(pool_size, retries, timeout)
+        return _session_pool
+
+
+def get_session():
+    '''Return the session shared by the download functions of this
+       process, creating it with the default configuration if need be
+    '''
+    global _session_pool
+    with _session_lock:
+        if _session_pool is None:
+            _session_pool = SessionPool()
+        return _session_pool
+
+
+def https_download(url, scheme=None, log=None, auth=None, payload={}):
     '''Sends an HTTP(S) request to the provided URL and writes the
        response to sys.stdout
 
+       The request is made with the shared session (see get_session()),
+       so connections are reused across calls.
+
        url(str): the full URL to the resource to download
-       scheme(str): one of "http" or "https"
+       scheme: deprecated and ignored (the URL's scheme is used)
        log: A logging object to which to write logs
        auth(dict): username/passwords contained in a dict with two keys
                    'u' and 'p'
        payload(dict):
     '''
 
+    if scheme is not None:
+        warnings.warn('The scheme argument of https_download() is ignored',
+                      DeprecationWarning, stacklevel=2)
+
     if not log:
         log = logging.getLogger(__name__)
 
     if auth:
         auth = (auth['u'], auth['p'])
 
-    # Configure requests to use retry
-    s = requests.Session()
-    a = requests.adapters.HTTPAdapter(max_retries=3)
-    s.mount('{}://'.format(scheme), a)
     log.info("Downloading {0}".format(url))
-    resp = s.get(url, params=payload, auth=auth)
+    resp = get_session().get(url, params=payload, auth=auth)
 
     log.info('{}: {}'.format(resp.status_code, resp.url))
 
     if resp.status_code != 200:
+        scheme = urllib.parse.urlsplit(url).scheme
         raise IOError(
             "{} {} error for {}".format(scheme.upper(), resp.status_code,
                                         resp.url))
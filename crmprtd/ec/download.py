@@ -49,8 +49,7 @@ def download(time, frequency, province, language):
         # Construct and download the xml
         url = makeurl(frequency, province, language, time)
 
-        scheme, _ = url.split(':', 1)
-        https_download(url, scheme, log)
+        https_download(url, log=log)
 
     except IOError:
         log.exception("Unable to download or open xml data")
@@ -1,9 +1,21 @@
-from crmprtd.swob_ml import normalize as swob_ml_normalize
+from crmprtd.swob_ml import normalize as swob_ml_normalize, \
+    normalize_batches as swob_ml_normalize_batches
 
 
-def normalize(file_stream):
+def normalize(file_stream, workers=None, ordered=True):
     return swob_ml_normalize(
         file_stream,
         'EC_raw',
-        station_id_attr='climate_station_number'
+        station_id_attr='climate_station_number',
+        workers=workers,
+        ordered=ordered
+    )
+
+
+def normalize_batches(file_stream, batch_size=None):
+    return swob_ml_normalize_batches(
+        file_stream,
+        'EC_raw',
+        station_id_attr='climate_station_number',
+        batch_size=batch_size
     )
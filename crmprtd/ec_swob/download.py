@@ -14,65 +14,157 @@ could result in data loss.
 '''
 
 import re
+import sys
+import time
 import datetime
 import logging
+import threading
 import urllib.parse
 from io import BytesIO
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from lxml import html
-import requests
 
-from crmprtd.download import https_download
+from crmprtd.download import get_session, configure_session, POOL_SIZE
 from crmprtd import logging_args, setup_logging
 
 
 log = logging.getLogger(__name__)
 
+# Size of the reads made by split_multi_xml_stream()
+CHUNK_SIZE = 2 ** 16
+XML_DECLARATION = b'<?xml'
+# Number of concurrent requests made by crawl()
+CONCURRENCY = 8
+
+
+def file_pattern(date):
+    # Match something like this: 2019-10-18-1600-bc-env-asw-1a02p-AUTO-swob.xml
+    return re.compile(r'{}.*swob\.xml'.format(date.strftime('%Y-%m-%d-%H')))
+
+
+def parse_listing(base_url, content, date):
+    '''Return the URLs linked to by an HTML directory listing that are
+       below it in the directory tree and are not for a different day
+    '''
+    tree = html.fromstring(content)
+    urls = tree.xpath('//a/@href')
+    # Skip URLs that point to the same page (path is empty)
+    urls = [urllib.parse.urljoin(base_url, url) for url in urls if
+            urllib.parse.urlparse(url).path]
+    # Skip URLs that are for a different day of interest
+    urls = [url for url in urls if match_date(url, date)]
+    # Skip URLs that move up the directory tree
+    return [url for url in urls if url.startswith(base_url)]
+
 
 def get_url_list(
     base_url='https://dd.weather.gc.ca/observations/swob-ml/partners/'
              'bc-env-snow/',
-    date=datetime.datetime.now()
+    date=datetime.datetime.now(),
+    concurrency=CONCURRENCY
 ):
     '''Recursively search an HTML directory tree and yield a set of
-       swob.xml URLs that match the given date and hour
+       swob.xml URLs that match the given date and hour (see crawl())
+    '''
+    for url, _ in crawl(base_url, date, concurrency, fetch=False):
+        yield url
+
+
+class RateLimiter(object):
+    '''Spaces out the requests made to each host (from any thread) so
+       that there are at most rate of them per second. A rate of None
+       means no limit.
     '''
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_times = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_times.get(host, now))
+            self.next_times[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def list_directory(url, date, rate_limiter):
+    rate_limiter.wait(url)
+    log.debug("Downloading {}".format(url))
+    page = get_session().get(url)
+    if page.status_code != 200:
+        return []
+    return parse_listing(url, page.content, date)
+
+
+def download_file(url, rate_limiter):
+    rate_limiter.wait(url)
+    log.info("Downloading {0}".format(url))
+    resp = get_session().get(url)
+    log.info('{}: {}'.format(resp.status_code, resp.url))
+    if resp.status_code != 200:
+        raise IOError(
+            "HTTPS {} error for {}".format(resp.status_code, resp.url))
+    return resp.content
+
+
+def crawl(base_url, date, concurrency=CONCURRENCY, rate_limit=None,
+          fetch=True):
+    '''Concurrently search an HTML directory tree for the swob.xml files
+       that match the given date and hour, and download them
+
+       Directory listings and files are fetched by a pool of concurrency
+       threads, making at most rate_limit requests per second to each
+       host, so files are downloaded while the rest of the tree is still
+       being searched. Yields a (url, content) pair for each file, in
+       the order in which their downloads complete. Raises IOError if
+       any file can not be downloaded.
+
+       If fetch is False, the files are only found, not downloaded, and
+       each is yielded with a content of None.
+    '''
+    rate_limiter = RateLimiter(rate_limit)
+    search_pattern = file_pattern(date)
     seen = {base_url}
-    queue = [base_url]
-    sesh = requests.Session()
 
-    # Match something like this: 2019-10-18-1600-bc-env-asw-1a02p-AUTO-swob.xml
-    search_pattern = re.compile(r'{}.*swob\.xml'.
-                                format(date.strftime('%Y-%m-%d-%H')))
-
-    while queue:
-        # pop the first item off the queue and download
-        base_url = queue.pop(0)
-        # search for URLs
-
-        log.debug("Downloading {}".format(base_url))
-        page = sesh.get(base_url)
-
-        if page.status_code != 200:
-            continue
-        tree = html.fromstring(page.content)
-        urls = tree.xpath('//a/@href')
-        # Skip URLs that point to the same page (path is empty)
-        urls = [urllib.parse.urljoin(base_url, url) for url in urls if
-                urllib.parse.urlparse(url).path]
-        # Skip URLs that are for a different day of interest
-        urls = [url for url in urls if match_date(url, date)]
-        # Skip URLs that move up the directory tree
-        urls = [url for url in urls if url.startswith(base_url)]
-
-        # either return them or add to the queue
-        for url in urls:
-            if search_pattern.search(url):
-                yield url
-            elif url not in seen and not url.endswith('xml'):
-                queue.append(url)
-            seen.add(url)
+    with ThreadPoolExecutor(concurrency) as executor:
+        # The function and URL of each future
+        pending = {}
+
+        def submit(func, url, *args):
+            pending[executor.submit(func, url, *args)] = (func, url)
+
+        submit(list_directory, base_url, date, rate_limiter)
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    func, url = pending.pop(future)
+                    if func is download_file:
+                        yield url, future.result()
+                        continue
+                    for child in future.result():
+                        if child in seen:
+                            continue
+                        seen.add(child)
+                        if search_pattern.search(child):
+                            if fetch:
+                                submit(download_file, child, rate_limiter)
+                            else:
+                                yield child, None
+                        elif not child.endswith('xml'):
+                            submit(list_directory, child, date, rate_limiter)
+        finally:
+            # Don't wait for the rest if we stopped early
+            for future in pending:
+                future.cancel()
 
 
 def match_date(url, date):
@@ -84,19 +176,55 @@ def match_date(url, date):
     return bool(has_a_date.search(url)) == bool(has_this_date.search(url))
 
 
-def download(base_url, date):
-    urls = get_url_list(base_url, date)
-    for url in urls:
-        https_download(url, log=log)
+def download(base_url, date, concurrency=CONCURRENCY, rate_limit=None):
+    '''Download the swob.xml files for the given date and hour below
+       base_url concurrently (see crawl()) and write them to stdout. Each
+       file is written whole, once its download is complete.
+    '''
+    for url, content in crawl(base_url, date, concurrency, rate_limit):
+        sys.stdout.buffer.write(content)
+    log.info('HTTP connections', extra={'connections': get_session().stats()})
+
+
+def split_multi_xml_stream(stream, chunk_size=CHUNK_SIZE):
+    '''Split a stream of concatenated XML documents into one BytesIO
+       per document, each starting with its XML declaration. Anything
+       before the first declaration is discarded.
+
+       The stream is read incrementally, and each document is yielded as
+       soon as the declaration of the next one has been read, so only
+       about one document is held in memory at a time.
+    '''
+    # Return whatever is available rather than waiting for a full chunk
+    read = getattr(stream, 'read1', stream.read)
+    buf = bytearray()
+    in_doc = False
+    pos = 0
+
+    while True:
+        chunk = read(chunk_size)
+        buf += chunk
+
+        while True:
+            i = buf.find(XML_DECLARATION, pos)
+            if i < 0:
+                break
+            if in_doc:
+                yield BytesIO(bytes(buf[:i]))
+            del buf[:i]
+            in_doc = True
+            pos = 1
 
+        if not chunk:
+            break
+        # A declaration may straddle the end of this chunk
+        pos = max(pos, len(buf) - len(XML_DECLARATION) + 1)
+        if not in_doc:
+            del buf[:pos]
+            pos = 0
 
-def split_multi_xml_stream(stream):
-    string = stream.read()
-    matches = re.split(b'(<\?xml.*?\?>)', string)
-    matches = matches[1:]
-    for _ in range(len(matches) // 2):
-        rv = BytesIO(matches.pop(0) + matches.pop(0))
-        yield rv
+    if in_doc:
+        yield BytesIO(bytes(buf))
 
 
 def main(partner):
@@ -120,6 +248,17 @@ def main(partner):
                         help=("Alternate date to use for downloading "
                               "(interpreted with "
                               "strptime(format='Y/m/d H:M:S')"))
+    parser.add_argument('--concurrency', type=int,
+                        default=CONCURRENCY,
+                        help='Maximum number of concurrent requests')
+    parser.add_argument('--rate_limit', type=float,
+                        default=None,
+                        help='Maximum number of requests per second to '
+                             'each host (no limit by default)')
+    parser.add_argument('--timeout', type=float,
+                        default=None,
+                        help='Seconds to wait to connect and for each read '
+                             'of a response (forever by default)')
     args = parser.parse_args()
 
     setup_logging(args.log_conf, args.log_filename, args.error_email,
@@ -130,9 +269,12 @@ def main(partner):
     else:
         dl_date = datetime.datetime.strptime(args.date, '%Y/%m/%d %H:%M:%S')
 
+    # Keep a connection open for each concurrent request
+    configure_session(pool_size=max(POOL_SIZE, args.concurrency),
+                      timeout=args.timeout)
     download(
         'https://dd.weather.gc.ca/observations/swob-ml/partners/{}/'
-        .format(partner), dl_date
+        .format(partner), dl_date, args.concurrency, args.rate_limit
     )
 
 
@@ -9,11 +9,19 @@ speed and reliability. This phase is common to all networks.
 """
 
 from math import floor, log as mathlog
-from sqlalchemy import and_
+from io import StringIO
+from itertools import chain
+from collections import defaultdict
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import and_, cast
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.types import TIMESTAMP
 import logging
 import time
 from sqlalchemy.exc import IntegrityError
-import random
+import psycopg2
+from psycopg2.extras import execute_values
 
 from crmprtd.db_exceptions import InsertionError
 from pycds import Obs
@@ -26,15 +34,20 @@ class DBMetrics(object):
     '''Keep track of database metrics during the insertion process.
     '''
 
-    def __init__(self, successes, skips, failures):
+    def __init__(self, successes, skips, failures, savepoints=0,
+                 rollbacks=0):
         self.successes = successes
         self.skips = skips
         self.failures = failures
+        self.savepoints = savepoints
+        self.rollbacks = rollbacks
 
     def __add__(self, another):
         return DBMetrics(self.successes + another.successes,
                          self.skips + another.skips,
-                         self.failures + another.failures)
+                         self.failures + another.failures,
+                         self.savepoints + another.savepoints,
+                         self.rollbacks + another.rollbacks)
 
 
 class Timer(object):
@@ -60,6 +73,16 @@ def get_chunk_sizes(remainder):
     return chunk_list
 
 
+def as_orm(obs):
+    '''Converts any compact observation records (see
+       crmprtd.align.ObsRecord) to pycds.Obs objects
+    '''
+    return [o if isinstance(o, Obs) else
+            Obs(history_id=o.history_id, vars_id=o.vars_id,
+                time=o.time, datum=o.datum)
+            for o in obs]
+
+
 def chunks(obs):
     pos = 0
     for chunk_size in get_chunk_sizes(len(obs)):
@@ -67,56 +90,92 @@ def chunks(obs):
         pos += chunk_size
 
 
-def get_sample_indices(num_obs, sample_size):
-    if sample_size > num_obs:
-        sample_size = num_obs
+class AdaptiveChunker(object):
+    '''Splits observations into chunks whose size adapts to the rate of
+       unique constraint failures seen so far in the run
 
-    return random.sample(range(num_obs), sample_size)
+       After a chunk is committed cleanly the next chunk is twice as
+       large. After a chunk fails, the next chunk is shrunk to the
+       expected length of a clean run at the observed failure rate
+       (rounded down to a power of two). The size is bounded by
+       min_size and max_size and can be saved and reused as the
+       starting size of the next run (see load_chunk_size()).
+    '''
 
+    def __init__(self, size=4096, min_size=1, max_size=65536):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = max(min_size, min(size, max_size))
 
-def obs_exist(sesh, history_id, vars_id, time):
-    q = sesh.query(Obs).filter(
-        and_(Obs.history_id == history_id, Obs.vars_id == vars_id,
-             Obs.time == time))
-    return q.count() > 0
+    def succeeded(self):
+        self.size = min(self.size * 2, self.max_size)
 
+    def failed(self, num_obs, num_failed):
+        clean_run = max(num_obs // (num_failed + 1), 1)
+        self.size = max(min(pow_two_chunk(clean_run), self.size // 2),
+                        self.min_size)
 
-def contains_all_duplicates(sesh, observations, sample_size):
-    sample_obs = []
-    sample_indices = get_sample_indices(len(observations), sample_size)
+    def chunks(self, obs):
+        pos = 0
+        while pos < len(obs):
+            chunk = obs[pos:pos+self.size]
+            pos += len(chunk)
+            yield chunk
 
-    for index in sample_indices:
-        sample_obs.append(observations[index])
 
-    for sample in sample_obs:
-        if not obs_exist(sesh, sample.history_id, sample.vars_id, sample.time):
-            return False
+def load_chunk_size(path, default=4096):
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except (OSError, ValueError) as e:
+        log.info('Using the default chunk size',
+                 extra={'path': path, 'exception': e})
+        return default
 
-    return True
 
+def save_chunk_size(path, size):
+    with open(path, 'w') as f:
+        f.write('{}\n'.format(size))
 
-def single_insert_obs(sesh, obs):
-    dbm = DBMetrics(0, 0, 0)
-    for o in obs:
-        if obs_exist(sesh, o.history_id, o.vars_id, o.time):
-            dbm.skips += 1
-            log.debug('Observation already exists in database',
-                      extra={'obs_id': o.id})
-            continue
 
-        # value does not exist in obs_raw, continue with insertion
-        try:
-            sesh.add(o)
-            sesh.commit()
-            log.debug("Successfully inserted observation")
-            dbm.successes += 1
-        except Exception as e:
-            log.warning("Failure, an error occured.", extra={'e': e})
-            sesh.rollback()
-            dbm.failures += 1
-            raise InsertionError(obs_time=o.time, datum=o.datum,
-                                 vars_id=o.vars_id, hid=o.history_id, e=e)
-    return dbm
+def filter_existing(sesh, observations):
+    '''Finds exactly which observations already exist in the database
+
+       For each (history_id, vars_id) in the batch, the times already in
+       obs_raw are fetched with one range query over the batch's time
+       span, and compared with the batch in memory. Repeats of an
+       observation within the batch are also filtered out.
+
+       Returns a list of the new observations and the number of
+       observations which were filtered out.
+    '''
+    groups = defaultdict(list)
+    for o in observations:
+        groups[(o.history_id, o.vars_id)].append(o)
+
+    new_obs = []
+    for (history_id, vars_id), group in groups.items():
+        times = [o.time for o in group]
+        # Fetch each time both as stored (naive) and in absolute terms so
+        # that it can be matched against both naive and aware datetimes
+        q = sesh.query(Obs.time, cast(Obs.time, TIMESTAMP(timezone=True)))\
+            .filter(and_(Obs.history_id == history_id,
+                         Obs.vars_id == vars_id,
+                         Obs.time.between(min(times), max(times))))
+        existing = set(chain.from_iterable(q))
+
+        for o in group:
+            if o.time in existing:
+                continue
+            existing.add(o.time)
+            new_obs.append(o)
+
+    num_existing = len(observations) - len(new_obs)
+    log.info("Filtered out existing observations",
+             extra={'num_obs': len(observations),
+                    'num_existing': num_existing,
+                    'num_queries': len(groups)})
+    return new_obs, num_existing
 
 
 def split(tuple_):
@@ -158,16 +217,16 @@ def bisect_insert_strategy(sesh, obs):
             log.debug("Failure, observation already exists",
                       extra={'obs': obs, 'exception': e})
             sesh.rollback()
-            return DBMetrics(0, 1, 0)
+            return DBMetrics(0, 1, 0, savepoints=1, rollbacks=1)
         except InsertionError as e:
             log.warning("Failure occured during insertion",
                         extra={'obs': obs, 'exception': e})
             sesh.rollback()
-            return DBMetrics(0, 0, 1)
+            return DBMetrics(0, 0, 1, savepoints=1, rollbacks=1)
         else:
             log.debug("Success for single observation")
             sesh.commit()
-            return DBMetrics(1, 0, 0)
+            return DBMetrics(1, 0, 0, savepoints=1)
 
     # The happy case: add everything at once
     else:
@@ -182,29 +241,310 @@ def bisect_insert_strategy(sesh, obs):
             a, b = split(obs)
             dbm_a = bisect_insert_strategy(sesh, a)
             dbm_b = bisect_insert_strategy(sesh, b)
-            return dbm_a + dbm_b
+            return dbm_a + dbm_b + DBMetrics(0, 0, 0, savepoints=1,
+                                             rollbacks=1)
         else:
             log.info("Successfully inserted observations",
                      extra={'num_obs': len(obs)})
             sesh.commit()
-            return DBMetrics(len(obs), 0, 0)
+            return DBMetrics(len(obs), 0, 0, savepoints=1)
+
 
+def copy_rows(obs):
+    '''Writes observations to a buffer in PostgreSQL's COPY text format
+    '''
+    buf = StringIO()
+    for o in obs:
+        datum = '\\N' if o.datum is None else o.datum
+        buf.write('{}\t{}\t{}\t{}\n'.format(
+            o.history_id, o.vars_id, o.time.isoformat(), datum))
+    buf.seek(0)
+    return buf
+
+
+def copy_insert_strategy(sesh, obs):
+    '''This function implements a bulk Obs insert strategy which
+       COPYs the whole set into a temporary staging table and then
+       moves it into obs_raw with a single INSERT ... ON CONFLICT DO
+       NOTHING. Observations which violate the unique constraint are
+       skipped by the database (and counted as skips), so the set is
+       inserted in one transaction regardless of how many duplicates
+       it contains.
+
+       Any other integrity error (e.g. a foreign key violation) aborts
+       the INSERT, and a value which can not be COPYed aborts the COPY,
+       in which case the set falls back to the bisection strategy.
+    '''
+    if len(obs) < 1:
+        return DBMetrics(0, 0, 0)
 
-def insert(sesh, observations, sample_size):
-    if contains_all_duplicates(sesh, observations, sample_size):
-        log.info("Using Single Insert Strategy")
-        with Timer() as tmr:
-            dbm = single_insert_obs(sesh, observations)
+    log.debug("Begin COPY observation insertion", extra={'num_obs': len(obs)})
+
+    # The obs_time column is a timestamp without time zone, so stage the
+    # times as timestamptz to get the same conversion as the ORM does
+    sesh.execute("""
+        CREATE TEMPORARY TABLE IF NOT EXISTS obs_raw_staging (
+            history_id integer,
+            vars_id integer,
+            obs_time timestamptz,
+            datum double precision
+        ) ON COMMIT DROP
+""")
+    try:
+        cursor = sesh.connection().connection.cursor()
+        cursor.copy_expert(
+            "COPY obs_raw_staging (history_id, vars_id, obs_time, datum) "
+            "FROM STDIN", copy_rows(obs))
+    except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+        log.warning("COPY failed, falling back to bisection",
+                    extra={'num_obs': len(obs), 'exception': e})
+        sesh.rollback()
+        return bisect_insert_strategy(sesh, as_orm(obs)) + \
+            DBMetrics(0, 0, 0, rollbacks=1)
+
+    try:
+        q = sesh.execute("""
+            INSERT INTO {} (history_id, vars_id, obs_time, datum)
+            SELECT history_id, vars_id, obs_time, datum
+            FROM obs_raw_staging
+            ON CONFLICT DO NOTHING
+            RETURNING 1
+""".format(Obs.__table__.fullname))
+        successes = len(q.fetchall())
+    except IntegrityError as e:
+        log.warning("COPY insertion failed, falling back to bisection",
+                    extra={'num_obs': len(obs), 'exception': e})
+        sesh.rollback()
+        return bisect_insert_strategy(sesh, as_orm(obs)) + \
+            DBMetrics(0, 0, 0, rollbacks=1)
+
+    sesh.commit()
+    log.info("Successfully inserted observations",
+             extra={'num_obs': successes})
+    return DBMetrics(successes, len(obs) - successes, 0)
+
+
+def core_insert_strategy(sesh, obs, page_size=1000):
+    '''This function implements an Obs insert strategy which bypasses
+       the ORM entirely. Observations (pycds.Obs objects or compact
+       ObsRecords) are written with psycopg2's execute_values() in
+       multi-row INSERT ... ON CONFLICT DO NOTHING statements of
+       page_size rows each, all in one transaction. Observations which
+       violate the unique constraint are counted as skips.
+
+       Any other integrity error aborts the transaction, in which case
+       the set falls back to the bisection strategy.
+    '''
+    if len(obs) < 1:
+        return DBMetrics(0, 0, 0)
 
+    log.debug("Begin Core observation insertion",
+              extra={'num_obs': len(obs)})
+
+    cursor = sesh.connection().connection.cursor()
+    try:
+        rows = execute_values(
+            cursor,
+            "INSERT INTO {} (history_id, vars_id, obs_time, datum) "
+            "VALUES %s ON CONFLICT DO NOTHING RETURNING 1"
+            .format(Obs.__table__.fullname),
+            ((o.history_id, o.vars_id, o.time, o.datum) for o in obs),
+            page_size=page_size, fetch=True)
+    except psycopg2.IntegrityError as e:
+        log.warning("Core insertion failed, falling back to bisection",
+                    extra={'num_obs': len(obs), 'exception': e})
+        sesh.rollback()
+        return bisect_insert_strategy(sesh, as_orm(obs)) + \
+            DBMetrics(0, 0, 0, rollbacks=1)
+
+    sesh.commit()
+    log.info("Successfully inserted observations",
+             extra={'num_obs': len(rows)})
+    return DBMetrics(len(rows), len(obs) - len(rows), 0)
+
+
+def insert_observations(sesh, observations, strategy='bisect',
+                        chunker=None):
+    '''Filters out existing observations and inserts the rest on the
+       given session using the given strategy (see insert()).
+
+       Returns a DBMetrics object.
+    '''
+    observations, num_existing = filter_existing(sesh, observations)
+    dbm = DBMetrics(0, num_existing, 0)
+
+    if strategy == 'copy':
+        log.info("Using COPY Strategy")
+        dbm += copy_insert_strategy(sesh, observations)
+    elif strategy == 'core':
+        log.info("Using Core Insert Strategy")
+        dbm += core_insert_strategy(sesh, observations)
     else:
         log.info("Using Chunk + Bisection Strategy")
-        with Timer() as tmr:
-            dbm = DBMetrics(0, 0, 0)
-            for chunk in chunks(observations):
-                dbm += bisect_insert_strategy(sesh, chunk)
+        if chunker is None:
+            chunker = AdaptiveChunker()
+        for chunk in chunker.chunks(observations):
+            chunk_dbm = bisect_insert_strategy(sesh, as_orm(chunk))
+            if chunk_dbm.rollbacks:
+                chunker.failed(len(chunk),
+                               chunk_dbm.skips + chunk_dbm.failures)
+            else:
+                chunker.succeeded()
+            dbm += chunk_dbm
+    return dbm
 
-    log.info('Data insertion complete')
+
+def shard(observations, num_shards):
+    '''Partitions observations by history_id. Observations in different
+       shards can never conflict on the obs_raw unique constraint.
+    '''
+    shards = [[] for _ in range(num_shards)]
+    for o in observations:
+        shards[o.history_id % num_shards].append(o)
+    return [s for s in shards if s]
+
+
+def pool_size(workers, default=5):
+    '''Returns a connection pool size for an engine which inserts with
+       `workers` threads, leaving room for the align and insert sessions
+    '''
+    return max(default, workers + 2)
+
+
+def available_connections(engine):
+    '''Returns the number of connections that the engine's pool can
+       still hand out, or None if it is unbounded
+    '''
+    pool = engine.pool
+    try:
+        capacity = pool.size() + pool._max_overflow
+        in_use = pool.checkedout()
+    except AttributeError:
+        return None
+    if pool._max_overflow < 0:
+        return None
+    return capacity - in_use
+
+
+def parallel_insert(sesh, observations, workers, strategy='bisect',
+                    chunker=None, executor=None, Session=None):
+    '''Shards the observations by history_id and inserts each shard on
+       its own connection from a pool of `workers` threads.
+
+       Each shard adapts its own chunk size, starting from the given
+       chunker's. Afterwards the chunker is left at the smallest size
+       that any shard settled on.
+
+       executor and Session may be given to reuse a ThreadPoolExecutor
+       and sessionmaker across calls (see insert_batches()).
+
+       Returns the sum of the shards' DBMetrics.
+    '''
+    if executor is None:
+        with ThreadPoolExecutor(workers) as executor:
+            return parallel_insert(sesh, observations, workers, strategy,
+                                   chunker, executor, Session)
+    if chunker is None:
+        chunker = AdaptiveChunker()
+    if Session is None:
+        Session = sessionmaker(sesh.get_bind())
+
+    def insert_shard(obs):
+        shard_sesh = Session()
+        shard_chunker = AdaptiveChunker(chunker.size, chunker.min_size,
+                                        chunker.max_size)
+        try:
+            dbm = insert_observations(shard_sesh, obs, strategy,
+                                      shard_chunker)
+        finally:
+            shard_sesh.close()
+        return dbm, shard_chunker.size
+
+    shards = shard(observations, workers)
+    log.info("Inserting in parallel", extra={'num_obs': len(observations),
+                                             'num_shards': len(shards)})
+    results = list(executor.map(insert_shard, shards))
+
+    dbm = DBMetrics(0, 0, 0)
+    for shard_dbm, _ in results:
+        dbm += shard_dbm
+    if results:
+        chunker.size = min(size for _, size in results)
+    return dbm
+
+
+def insert_batches(sesh, batches, strategy='bisect', chunker=None,
+                   workers=1):
+    '''Inserts each batch of observations from an iterable of batches
+       in turn (see insert()), so that only one batch need be held in
+       memory at a time. The chunker carries over from batch to batch.
+
+       With workers > 1, one pool of threads is used for all of the
+       batches. The number of workers is capped at the number of
+       connections that the session's engine can still hand out, since
+       any more would only wait for a connection (or time out).
+
+       Returns the same results record as insert(), aggregated over all
+       of the batches.
+    '''
+    if chunker is None:
+        chunker = AdaptiveChunker()
+
+    if workers > 1:
+        available = available_connections(sesh.get_bind())
+        if available is not None and available < workers:
+            log.warning('Not enough database connections for all workers',
+                        extra={'workers': workers,
+                               'connections': available})
+            workers = max(available, 1)
+
+    dbm = DBMetrics(0, 0, 0)
+    num_batches = 0
+    # Only time the insertions, not the production of the batches
+    run_time = 0
+    with ExitStack() as stack:
+        if workers > 1:
+            executor = stack.enter_context(ThreadPoolExecutor(workers))
+            Session = sessionmaker(sesh.get_bind())
+        for observations in batches:
+            with Timer() as tmr:
+                if workers > 1:
+                    dbm += parallel_insert(sesh, observations, workers,
+                                           strategy, chunker, executor,
+                                           Session)
+                else:
+                    dbm += insert_observations(sesh, observations, strategy,
+                                               chunker)
+            run_time += tmr.run_time
+            num_batches += 1
+
+    log.info('Data insertion complete', extra={'num_batches': num_batches})
     return {'successes': dbm.successes,
             'skips': dbm.skips,
             'failures': dbm.failures,
-            'insertions_per_sec': round(dbm.successes/tmr.run_time, 2)}
+            'savepoints': dbm.savepoints,
+            'rollbacks': dbm.rollbacks,
+            'insertions_per_sec': (round(dbm.successes/run_time, 2)
+                                   if run_time else 0)}
+
+
+def insert(sesh, observations, sample_size=None, strategy='bisect',
+           chunker=None, workers=1):
+    '''Inserts the observations using the given strategy:
+
+       bisect: inserts chunks of observations, bisecting any chunk that
+               fails on a unique constraint. Chunk sizes are chosen by
+               the given AdaptiveChunker (or a new one).
+       copy: uses COPY and a single INSERT ... ON CONFLICT DO NOTHING
+       core: uses paged multi-row INSERT ... ON CONFLICT DO NOTHING
+             statements without going through the ORM
+
+       The observations may be pycds.Obs objects or compact ObsRecords.
+
+       Observations which already exist in the database are filtered
+       out beforehand with filter_existing() and counted as skips.
+       If workers > 1, observations are sharded by history_id and the
+       shards are inserted concurrently (see parallel_insert()).
+       The sample_size argument is no longer used.
+    '''
+    return insert_batches(sesh, [observations], strategy, chunker, workers)
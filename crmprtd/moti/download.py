@@ -89,7 +89,8 @@ def download(username, password, auth_fname, auth_key,
     url = 'https://prdoas2.apps.th.gov.bc.ca/saw-data/sawr7110'
 
     try:
-        crmprtd.download.https_download(url, 'https', log, auth, payload)
+        crmprtd.download.https_download(url, log=log, auth=auth,
+                                        payload=payload)
 
     except IOError:
         log.exception("Unable to download or open xml data")
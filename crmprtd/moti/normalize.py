@@ -1,16 +1,15 @@
 #!/usr/bin/env python
 
 # Standard module
-import pytz
 import logging
 
 # Installed libraries
 from pkg_resources import resource_filename
-from lxml.etree import XSLT, parse as xmlparse
-from dateutil.parser import parse as dateparse
+from lxml.etree import XSLT, iterparse, parse as xmlparse
 
 # Local
 from crmprtd import Row
+from crmprtd.timeparse import parse_utc
 
 
 xsl = resource_filename('crmprtd', 'data/moti.xsl')
@@ -21,71 +20,128 @@ ns = {
 log = logging.getLogger(__name__)
 
 
+# The renaming of variables and units done by moti.xsl
+VARIABLE_NAMES = {
+    'air-temperature': 'CURRENT_AIR_TEMPERATURE1',
+    'atmospheric': 'ATMOSPHERIC_PRESSURE',
+    'average-scalar-speed-over-60minutes': 'MEASURED_WIND_SPEED1',
+    'average-direction': 'MEASURED_WIND_DIRECTION1',
+    'standard-deviation-of-direction-over-60minutes':
+        'WIND_DIRECTION_STD_DEVIATION1',
+    'dew-point': 'DEW_POINT',
+    'total-over-hour': 'HOURLY_PRECIPITATION',
+    'relative-humidity': 'RELATIVE_HUMIDITY1',
+    'snowfall-accumulation-rate': '',
+    'adjacent-snow-depth': 'HEIGHT_OF_SNOW',
+}
+UNITS = {
+    'degC': 'celsius',
+    'mb': 'millibar',
+    'deg': 'degrees',
+    'km/h': 'km h-1',
+}
+
+
 def normalize(file_stream):
+    '''Normalizes a SAWR XML document incrementally
+
+       Each observation-series is normalized as soon as it has been
+       parsed and is then discarded, so the whole document is never held
+       in memory. Variables and units are renamed as moti.xsl does (see
+       normalize_xslt()).
+    '''
+    log.info('Starting MOTI data normalization')
+    for _, series in iterparse(file_stream, tag='observation-series'):
+        yield from normalize_series(series, VARIABLE_NAMES, UNITS)
+        # Free the series and anything that came before it
+        series.clear()
+        while series.getprevious() is not None:
+            del series.getparent()[0]
+
+
+def normalize_xslt(file_stream):
+    '''Normalizes a SAWR XML document by parsing all of it and applying
+       moti.xsl. Slower and uses more memory than normalize(), but is
+       kept to verify that they give the same results.
+    '''
     log.info('Starting MOTI data normalization')
     et = xmlparse(file_stream)
     et = transform(et)
     obs_series = et.xpath("//observation-series")
     for series in obs_series:
-        if not len(series):
-            log.warning("Empty observation series: xpath search "
-                        "'//observation-series' return no results")
+        yield from normalize_series(series)
+
+
+def normalize_series(series, variable_names=None, units=None):
+    '''Yields the rows of an observation-series element, optionally
+       renaming its variables and units with the given mappings
+    '''
+    if not len(series):
+        log.warning("Empty observation series: xpath search "
+                    "'//observation-series' return no results")
+        return
+    try:
+        stn_id = series.xpath(
+                    "./origin/id[@type='client']")[0].text.strip()
+    except IndexError as e:
+        log.error("Could not detect the station id: xpath search "
+                  "'//observation-series/origin/id[@type='client']' "
+                  "return no results", extra={'exception': e})
+        return
+
+    members = series.xpath('./observation', namespaces=ns)
+    for member in members:
+        # get time and convert to datetime
+        time = member.get('valid-time')
+        if not time:
+            log.warning("Could not find a valid-time attribute for this "
+                        "observation")
             continue
+
         try:
-            stn_id = series.xpath(
-                        "./origin/id[@type='client']")[0].text.strip()
-        except IndexError as e:
-            log.error("Could not detect the station id: xpath search "
-                      "'//observation-series/origin/id[@type='client']' "
-                      "return no results", extra={'exception': e})
+            # MoTI gives us an ISO formatted time string with
+            # timezone info attached so it should be sufficient to
+            # simply parse it and display it as UTC.
+            date = parse_utc(time)
+        except ValueError as e:
+            log.warning('Unable to convert value to datetime',
+                        extra={'time': time})
             continue
 
-        members = series.xpath('./observation', namespaces=ns)
-        for member in members:
-            # get time and convert to datetime
-            time = member.get('valid-time')
-            if not time:
-                log.warning("Could not find a valid-time attribute for this "
-                            "observation")
+        for obs in member.iterchildren():
+            variable_name = obs.get('type')
+            if variable_name is None:
                 continue
+            if variable_names is not None:
+                variable_name = variable_names.get(variable_name,
+                                                   variable_name)
 
             try:
-                # MoTI gives us an ISO formatted time string with
-                # timezone info attached so it should be sufficient to
-                # simply parse it and display it as UTC.
-                date = dateparse(time).astimezone(pytz.utc)
-            except ValueError as e:
-                log.warning('Unable to convert value to datetime',
-                            extra={'time': time})
+                value_element = obs.xpath('./value')[0]
+            except IndexError as e:
+                log.warning("Could not find the actual value for "
+                            "observation. xpath search './value' "
+                            "returned no results",
+                            extra={'variable_name': variable_name})
                 continue
 
-            for obs in member.iterchildren():
-                variable_name = obs.get('type')
-                if variable_name is None:
-                    continue
-
-                try:
-                    value_element = obs.xpath('./value')[0]
-                except IndexError as e:
-                    log.warning("Could not find the actual value for "
-                                "observation. xpath search './value' "
-                                "returned no results",
-                                extra={'variable_name': variable_name})
-                    continue
-
-                try:
-                    value = float(value_element.text)
-                except ValueError:
-                    log.error("Could not convert value to a number. "
-                              "Skipping this observation.",
-                              extra={'value': value_element})
-                    continue
-
-                yield Row(time=date,
-                          val=value,
-                          variable_name=variable_name,
-                          unit=value_element.get('units'),
-                          network_name='MoTIe',
-                          station_id=stn_id,
-                          lat=None,
-                          lon=None)
+            try:
+                value = float(value_element.text)
+            except ValueError:
+                log.error("Could not convert value to a number. "
+                          "Skipping this observation.",
+                          extra={'value': value_element})
+                continue
+
+            unit = value_element.get('units')
+            if units is not None:
+                unit = units.get(unit, unit)
+
+            yield Row(time=date,
+                      val=value,
+                      variable_name=variable_name,
+                      unit=unit,
+                      network_name='MoTIe',
+                      station_id=stn_id,
+                      lat=None,
+                      lon=None)
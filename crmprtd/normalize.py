@@ -0,0 +1,82 @@
+import sys
+import logging
+from argparse import ArgumentParser
+
+from crmprtd.rowbatch import RowBatch, write_batches
+from crmprtd.process import get_normalization_module, normalize_stream
+from crmprtd import logging_args, setup_logging
+
+# Number of rows written per frame of the normalized format
+FRAME_SIZE = 10000
+
+
+def normalize_args(parser):
+    parser.add_argument('-N', '--network',
+                        choices=['bc_env_aq', 'bc_env_snow', 'bc_forestry',
+                                 'bc_tran', 'crd', 'ec', 'moti', 'wamr',
+                                 'wmb'],
+                        required=True,
+                        help='The network from which the data is coming from. '
+                             'The name will be used for a dynamic import of '
+                             'the module\'s normalization function.')
+    parser.add_argument('--normalize_workers', type=int,
+                        default=None,
+                        help='Number of processes with which to normalize '
+                             'in parallel (bc_env_aq, bc_env_snow, '
+                             'bc_forestry, bc_tran, ec and wmb networks only; '
+                             'ignored for the others)')
+    parser.add_argument('--frame_size', type=int,
+                        default=FRAME_SIZE,
+                        help='Maximum number of rows per frame of output')
+    return parser
+
+
+def normalize(network, input_stream, output_stream, normalize_workers=None,
+              frame_size=FRAME_SIZE):
+    '''Executes the Normalize stage of the data processing pipeline alone.
+
+       Normalizes the data read from input_stream based on the network's
+       format, and writes the rows to output_stream in the normalized
+       format (see crmprtd.rowbatch), from which crmprtd_process
+       --input_format normalized can align and insert them. Returns the
+       number of rows written.
+    '''
+    log = logging.getLogger('crmprtd')
+    norm_mod = get_normalization_module(network)
+
+    if not normalize_workers and hasattr(norm_mod, 'normalize_batches'):
+        batches = norm_mod.normalize_batches(input_stream, frame_size)
+    else:
+        rows = normalize_stream(norm_mod, input_stream, normalize_workers)
+        batches = RowBatch.batches(rows, frame_size)
+
+    count = 0
+
+    def counted(batches):
+        nonlocal count
+        for batch in batches:
+            count += len(batch)
+            yield batch
+
+    write_batches(counted(batches), output_stream)
+    output_stream.flush()
+
+    log.info('Normalized rows', extra={'network': network, 'rows': count})
+    return count
+
+
+def main():
+    parser = ArgumentParser()
+    parser = normalize_args(parser)
+    parser = logging_args(parser)
+    args = parser.parse_args()
+
+    setup_logging(args.log_conf, args.log_filename, args.error_email,
+                  args.log_level, 'crmprtd')
+
+    normalize(args.network, sys.stdin.buffer, sys.stdout.buffer,
+              args.normalize_workers, args.frame_size)
+
+
+if __name__ == "__main__":
+    main()
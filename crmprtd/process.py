@@ -1,13 +1,18 @@
+import os
 import sys
 from importlib import import_module
+from inspect import signature
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 import logging
 from argparse import ArgumentParser
 
-from crmprtd.align import align
-from crmprtd.insert import insert
-from crmprtd import logging_args, setup_logging
+from crmprtd.align import Aligner
+from crmprtd.rowbatch import RowBatch, read_batches, read_rows
+from crmprtd.insert import insert_batches, AdaptiveChunker, pool_size
+from crmprtd import logging_args, setup_logging, batched, \
+    OVERLAP_BATCH_SIZE, load_snapshot, save_snapshot
+from crmprtd.stages import threaded
 
 
 def process_args(parser):
@@ -18,10 +23,8 @@ def process_args(parser):
                         default=False, action="store_true",
                         help="Turn on diagnostic mode (no commits)")
     parser.add_argument('--sample_size', type=int,
-                        default=50,
-                        help='Number of samples to be taken from observations '
-                             'when searching for duplicates '
-                             'to determine which insertion strategy to use')
+                        help='Deprecated and ignored. Existing observations '
+                             'are now found exactly before insertion')
     parser.add_argument('-N', '--network',
                         choices=['bc_env_aq', 'bc_env_snow', 'bc_forestry',
                                  'bc_tran', 'crd', 'ec', 'moti', 'wamr',
@@ -29,6 +32,55 @@ def process_args(parser):
                         help='The network from which the data is coming from. '
                              'The name will be used for a dynamic import of '
                              'the module\'s normalization function.')
+    parser.add_argument('--input_format',
+                        choices=['raw', 'normalized'],
+                        default='raw',
+                        help='Format of the input: "raw" data downloaded '
+                             'from the network, or rows already normalized '
+                             'by crmprtd_normalize')
+    parser.add_argument('--insert_strategy',
+                        choices=['bisect', 'copy', 'core'],
+                        default='bisect',
+                        help='Strategy used to insert observations. '
+                             '"bisect" inserts chunks and bisects those that '
+                             'fail on duplicates. "copy" COPYs the '
+                             'observations into a staging table and inserts '
+                             'them with ON CONFLICT DO NOTHING. "core" '
+                             'inserts pages of rows with ON CONFLICT DO '
+                             'NOTHING. Both "copy" and "core" bypass the ORM')
+    parser.add_argument('--workers', type=int,
+                        default=1,
+                        help='Number of concurrent database connections to '
+                             'insert with. Observations are sharded by '
+                             'history_id across the workers')
+    parser.add_argument('--normalize_workers', type=int,
+                        default=None,
+                        help='Number of processes with which to normalize '
+                             'in parallel (bc_env_aq, bc_env_snow, '
+                             'bc_forestry, bc_tran, ec and wmb networks only; '
+                             'ignored for the others)')
+    parser.add_argument('--batch_size', type=int,
+                        default=None,
+                        help='Stream the normalized rows through the align '
+                             'and insert phases in batches of at most this '
+                             'many rows, bounding memory use. By default, '
+                             'all rows are processed in one batch')
+    parser.add_argument('--columnar',
+                        default=False, action='store_true',
+                        help='Pass normalized rows to the align phase in '
+                             'compact columnar batches (see --batch_size)')
+    parser.add_argument('--overlap',
+                        default=False, action='store_true',
+                        help='Run the normalize, align and insert phases '
+                             'concurrently, each in its own thread, passing '
+                             'batches of rows between them (of --batch_size '
+                             'or {} rows)'.format(OVERLAP_BATCH_SIZE))
+    parser.add_argument('--snapshot_dir',
+                        default=None,
+                        help='Directory in which to keep state between runs '
+                             '(per network): a snapshot of the database '
+                             'metadata, so that runs start with a warm '
+                             'cache, and the learned insertion chunk size')
     return parser
 
 
@@ -36,12 +88,50 @@ def get_normalization_module(network):
     return import_module('crmprtd.{}.normalize'.format(network))
 
 
-def process(connection_string, sample_size, network, is_diagnostic=False):
+def supports_workers(norm_mod):
+    '''Returns whether a network's normalize() can run in parallel'''
+    return 'workers' in signature(norm_mod.normalize).parameters
+
+
+def normalize_stream(norm_mod, stream, workers=None):
+    '''Normalizes a stream with a network's normalize(), in parallel with
+       the given number of workers if the network supports it
+    '''
+    if workers and supports_workers(norm_mod):
+        return norm_mod.normalize(stream, workers=workers)
+    if workers:
+        logging.getLogger('crmprtd').warning(
+            'Network can not be normalized in parallel, ignoring workers',
+            extra={'network': norm_mod.__name__, 'workers': workers})
+    return norm_mod.normalize(stream)
+
+
+def process(connection_string, sample_size, network, is_diagnostic=False,
+            snapshot_dir=None, insert_strategy='bisect', workers=1,
+            batch_size=None, normalize_workers=None, columnar=False,
+            input_format='raw', overlap=False):
     '''Executes 3 stages of the data processing pipeline.
 
        Normalizes the data based on the network's format.
        The the fuction send the normalized rows through the align
-       and insert phases of the pipeline.
+       and insert phases of the pipeline, in batches of at most
+       batch_size rows if it is given. SWOB-ML networks and WMB may
+       normalize with a pool of normalize_workers processes. If
+       columnar is True, the batches are RowBatches rather than lists,
+       filled directly by the network's normalize_batches() if it has
+       one (currently WMB and the SWOB-ML networks).
+
+       If input_format is 'normalized', the input has already been
+       normalized by crmprtd_normalize and is read as is. The network
+       then only names the snapshot files. With columnar and no
+       batch_size, its frames are aligned as they were written.
+
+       If overlap is True, the phases run concurrently (see
+       crmprtd.stages): normalize and align each run in their own
+       thread, connected by bounded queues, while insert runs in this
+       one. Align and insert then use separate database sessions, and
+       rows are aligned in batches of batch_size (or OVERLAP_BATCH_SIZE)
+       rows.
     '''
     log = logging.getLogger('crmprtd')
 
@@ -50,27 +140,67 @@ def process(connection_string, sample_size, network, is_diagnostic=False):
                   extra={'network': network})
         raise Exception('No module name given')
 
-    download_stream = sys.stdin.buffer
-    norm_mod = get_normalization_module(network)
-
-    rows = [row for row in norm_mod.normalize(download_stream)]
+    if overlap:
+        batch_size = batch_size or OVERLAP_BATCH_SIZE
 
-    engine = create_engine(connection_string)
+    download_stream = sys.stdin.buffer
+    # Columnar batches are filled directly where possible, rather than
+    # by collecting rows
+    batches = rows = None
+    if input_format == 'normalized':
+        if columnar and batch_size is None:
+            batches = read_batches(download_stream)
+        else:
+            rows = read_rows(download_stream)
+    else:
+        norm_mod = get_normalization_module(network)
+        if columnar and not normalize_workers and \
+                hasattr(norm_mod, 'normalize_batches'):
+            batches = norm_mod.normalize_batches(download_stream, batch_size)
+        else:
+            rows = normalize_stream(norm_mod, download_stream,
+                                    normalize_workers)
+
+    engine = create_engine(connection_string, pool_size=pool_size(workers))
     Session = sessionmaker(engine)
     sesh = Session()
-
-    observations = [
-        ob for ob in [align(sesh, row, is_diagnostic) for row in rows] if ob
-    ]
+    # Sessions can not be shared between threads
+    align_sesh = Session() if overlap else sesh
+
+    # Only the bisection strategy requires ORM objects
+    aligner = Aligner(align_sesh, is_diagnostic,
+                      records=(insert_strategy != 'bisect'))
+    chunker = AdaptiveChunker()
+    if snapshot_dir:
+        snapshot = os.path.join(snapshot_dir, '{}.pickle'.format(network))
+        chunker = load_snapshot(aligner, snapshot)
+
+    if batches is None:
+        if columnar:
+            batches = RowBatch.batches(rows, batch_size)
+        else:
+            batches = batched(rows, batch_size)
+    if overlap:
+        batches = threaded(batches)
+    observations = (aligner.align_batch(batch) for batch in batches)
+    if overlap:
+        observations = threaded(observations)
 
     if is_diagnostic:
-        for obs in observations:
-            log.info(obs)
+        for batch in observations:
+            for obs in batch:
+                log.info(obs)
         return
 
-    results = insert(sesh, observations, sample_size)
+    results = insert_batches(sesh, observations, insert_strategy, chunker,
+                             workers)
+
+    if snapshot_dir:
+        save_snapshot(aligner, chunker, snapshot)
+
     log.info('Data insertion results', extra={
-        'results': results, 'network': network
+        'results': results, 'network': network,
+        'metadata_cache': aligner.cache_stats()
     })
 
 
@@ -83,7 +213,14 @@ def main():
     setup_logging(args.log_conf, args.log_filename, args.error_email,
                   args.log_level, 'crmprtd')
 
-    process(args.connection_string, args.sample_size, args.network, args.diag)
+    if args.sample_size is not None:
+        logging.getLogger('crmprtd').warning(
+            'The --sample_size option is deprecated and ignored')
+
+    process(args.connection_string, args.sample_size, args.network, args.diag,
+            args.snapshot_dir, args.insert_strategy, args.workers,
+            args.batch_size, args.normalize_workers, args.columnar,
+            args.input_format, args.overlap)
 
 
 if __name__ == "__main__":
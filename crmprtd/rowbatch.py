@@ -0,0 +1,289 @@
+"""rowbatch.py
+The rowbatch module provides RowBatch, a compact columnar alternative
+to a list of crmprtd.Row tuples for passing normalized observations
+from the Normalize phase to the Align phase.
+
+Times are stored as int64 microseconds since the epoch and values as
+float64, in arrays. The other fields repeat heavily (there are few
+distinct networks, variables, units and stations in a batch), so they
+are dictionary encoded: each distinct value is stored once and rows
+refer to it by index.
+
+RowBatches can also be written to and read from a file in the
+"normalized" format (see write_batches() and read_batches()), so that
+a download can be normalized once and then aligned and inserted many
+times. The format is a header (MAGIC and FORMAT_VERSION) followed by
+frames, one per RowBatch, each of which is a little endian uint32
+length followed by that many bytes:
+
+    uint32 number of rows (n)
+    int64[n] times, float64[n] values, uint8[n] missing value flags
+    for each of the encoded_fields:
+        uint32 length of, and a JSON list of, the distinct values
+        int32[n] codes
+"""
+
+import sys
+import json
+import struct
+from array import array
+from datetime import datetime, timedelta
+
+import pytz
+
+# crmprtd imports the Align phase, which imports this module
+import crmprtd
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+# Stands in for a missing time
+NO_TIME = -2 ** 63
+
+
+MAGIC = b'CRMPRTDN'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sH')
+UINT32 = struct.Struct('<I')
+
+
+def to_epoch(time):
+    '''Converts a timezone aware datetime to microseconds since the epoch
+    '''
+    if time.tzinfo is None:
+        raise ValueError('RowBatch times must be timezone aware')
+    return (time - EPOCH) // timedelta(microseconds=1)
+
+
+def from_epoch(micros):
+    '''Converts microseconds since the epoch to a UTC datetime'''
+    return EPOCH + timedelta(microseconds=micros)
+
+
+class DictionaryColumn(object):
+    '''A column of values stored as indices into a list of the distinct
+       values
+    '''
+
+    def __init__(self):
+        self.values = []
+        self.index = {}
+        self.codes = array('l')
+
+    def append(self, value):
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def from_values(cls, values, codes):
+        column = cls()
+        column.values = values
+        column.index = {value: code for code, value in enumerate(values)}
+        column.codes = array('l', codes)
+        return column
+
+
+class RowBatch(object):
+    '''A batch of normalized observations stored by column
+
+       Rows can be appended field by field (see append()) or as Row
+       tuples, and iterating over a batch yields Row tuples, so a
+       RowBatch can be used anywhere that a list of rows can. Times must
+       be timezone aware and are returned in UTC; values are returned as
+       floats.
+    '''
+
+    encoded_fields = ('variable_name', 'unit', 'network_name', 'station_id',
+                      'lat', 'lon')
+
+    def __init__(self, rows=()):
+        self.times = array('q')
+        self.vals = array('d')
+        # Marks missing values, since NaN is a value
+        self.val_missing = bytearray()
+        for name in self.encoded_fields:
+            setattr(self, name, DictionaryColumn())
+        # Normalizers pass the same time object for many rows in a row
+        self._last_time = self._last_epoch = NO_TIME
+        for row in rows:
+            self.append_row(row)
+
+    def append(self, time, val, variable_name, unit, network_name,
+               station_id, lat, lon):
+        if time is not self._last_time:
+            self._last_epoch = NO_TIME if time is None else to_epoch(time)
+            self._last_time = time
+        self.times.append(self._last_epoch)
+        self.vals.append(0.0 if val is None else val)
+        self.val_missing.append(val is None)
+        self.variable_name.append(variable_name)
+        self.unit.append(unit)
+        self.network_name.append(network_name)
+        self.station_id.append(station_id)
+        self.lat.append(lat)
+        self.lon.append(lon)
+
+    def append_row(self, row):
+        self.append(*row)
+
+    def time(self, i):
+        t = self.times[i]
+        return None if t == NO_TIME else from_epoch(t)
+
+    def val(self, i):
+        return None if self.val_missing[i] else self.vals[i]
+
+    def row(self, i):
+        return crmprtd.Row(time=self.time(i),
+                           val=self.val(i),
+                           variable_name=self.variable_name[i],
+                           unit=self.unit[i],
+                           network_name=self.network_name[i],
+                           station_id=self.station_id[i],
+                           lat=self.lat[i],
+                           lon=self.lon[i])
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        return (self.row(i) for i in range(len(self)))
+
+    def split(self, n):
+        '''Returns two RowBatches, of the first n rows and of the rest'''
+        parts = []
+        for rows in (slice(None, n), slice(n, None)):
+            part = RowBatch()
+            part.times = self.times[rows]
+            part.vals = self.vals[rows]
+            part.val_missing = self.val_missing[rows]
+            for name in self.encoded_fields:
+                column = getattr(self, name)
+                setattr(part, name, DictionaryColumn.from_values(
+                    list(column.values), column.codes[rows]))
+            parts.append(part)
+        return tuple(parts)
+
+    def to_bytes(self):
+        '''Encodes the batch as a frame payload of the normalized
+           format
+        '''
+        parts = [UINT32.pack(len(self)),
+                 _little_endian(self.times),
+                 _little_endian(self.vals),
+                 bytes(self.val_missing)]
+        for name in self.encoded_fields:
+            column = getattr(self, name)
+            values = json.dumps(column.values).encode('utf-8')
+            parts.extend((UINT32.pack(len(values)), values,
+                          _little_endian(array('i', column.codes))))
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        '''Decodes a frame payload written by to_bytes()'''
+        data = memoryview(data)
+        n, = UINT32.unpack_from(data)
+        offset = UINT32.size
+
+        def take(size):
+            nonlocal offset
+            if offset + size > len(data):
+                raise ValueError('Truncated RowBatch frame')
+            chunk = data[offset:offset + size]
+            offset += size
+            return chunk
+
+        batch = cls()
+        batch.times = _from_little_endian('q', take(8 * n))
+        batch.vals = _from_little_endian('d', take(8 * n))
+        batch.val_missing = bytearray(take(n))
+        for name in cls.encoded_fields:
+            size, = UINT32.unpack(take(UINT32.size))
+            values = json.loads(bytes(take(size)).decode('utf-8'))
+            codes = _from_little_endian('i', take(4 * n))
+            setattr(batch, name, DictionaryColumn.from_values(values, codes))
+        return batch
+
+    @classmethod
+    def batches(cls, rows, batch_size=None):
+        '''Collects an iterable of rows into RowBatches of at most
+           batch_size rows (or a single RowBatch if batch_size is None)
+        '''
+        batch = cls()
+        for row in rows:
+            batch.append_row(row)
+            if batch_size is not None and len(batch) >= batch_size:
+                yield batch
+                batch = cls()
+        if len(batch) or batch_size is None:
+            yield batch
+
+
+def _little_endian(arr):
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _from_little_endian(typecode, data):
+    arr = array(typecode)
+    arr.frombytes(data)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+
+def write_batches(batches, stream):
+    '''Writes RowBatches to a binary stream in the normalized format'''
+    stream.write(HEADER.pack(MAGIC, FORMAT_VERSION))
+    for batch in batches:
+        payload = batch.to_bytes()
+        stream.write(UINT32.pack(len(payload)))
+        stream.write(payload)
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated normalized stream')
+    return data
+
+
+def read_batches(stream):
+    '''Reads the RowBatches written to a binary stream by
+       write_batches(), lazily
+
+       Raises ValueError if the stream is not in the normalized format
+       or ends part way through a frame.
+    '''
+    header = stream.read(HEADER.size)
+    if len(header) != HEADER.size or header[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a normalized stream')
+    _, version = HEADER.unpack(header)
+    if version != FORMAT_VERSION:
+        raise ValueError('Unsupported normalized format version {}'
+                         .format(version))
+    while True:
+        prefix = stream.read(UINT32.size)
+        if not prefix:
+            return
+        if len(prefix) != UINT32.size:
+            raise ValueError('Truncated normalized stream')
+        size, = UINT32.unpack(prefix)
+        yield RowBatch.from_bytes(_read_exactly(stream, size))
+
+
+def read_rows(stream):
+    '''Reads the rows written to a binary stream by write_batches()'''
+    for batch in read_batches(stream):
+        yield from batch
@@ -0,0 +1,184 @@
+"""stages.py
+The stages module runs the phases of the crmprtd pipeline concurrently.
+
+Each phase is an iterator which is drained by its own worker (a thread,
+or optionally a process) into a bounded queue, from which the next
+phase reads. A worker blocks when its queue is full, so a fast phase
+never runs more than a few items ahead of a slow one, and the wall
+clock time of a run tends towards that of its slowest phase rather
+than the sum of all of them.
+
+Items are passed between workers in lists of up to batch_size items to
+amortize the cost of the queues. Any exception raised by a phase is
+re-raised by the consumer of its queue.
+"""
+
+import logging
+import pickle
+import threading
+import multiprocessing
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from queue import Queue, Full, Empty
+
+
+log = logging.getLogger(__name__)
+
+# Maximum number of batches waiting between two stages
+QUEUE_SIZE = 8
+# How often (in seconds) blocked workers check whether to stop
+POLL_INTERVAL = 0.1
+
+
+class _Failure(object):
+    '''Carries an exception raised by a stage to its consumer'''
+
+    def __init__(self, exc):
+        self.exc = exc
+
+    def __reduce__(self):
+        # Not every exception can be sent back from a process
+        try:
+            pickle.dumps(self.exc)
+            exc = self.exc
+        except Exception:
+            exc = RuntimeError(repr(self.exc))
+        return (_Failure, (exc,))
+
+
+def _put(queue, item, stop):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=POLL_INTERVAL)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def _produce(iterable, queue, stop, batch_size):
+    '''Drains an iterable into a queue in batches, followed by None'''
+    try:
+        it = iter(iterable)
+        while True:
+            batch = list(islice(it, batch_size))
+            if not batch:
+                break
+            if not _put(queue, batch, stop):
+                return
+        _put(queue, None, stop)
+    except Exception as e:
+        _put(queue, _Failure(e), stop)
+
+
+def _consume(queue, stop=None, process=None):
+    '''Yields the items put on a queue by _produce()'''
+    try:
+        while True:
+            try:
+                batch = queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                if process is None or process.is_alive():
+                    continue
+                # The process may have exited just after finishing, with
+                # its last batches still in transit
+                try:
+                    batch = queue.get(timeout=POLL_INTERVAL)
+                except Empty:
+                    raise RuntimeError('Stage process exited unexpectedly')
+            if batch is None:
+                return
+            if isinstance(batch, _Failure):
+                raise batch.exc
+            yield from batch
+    finally:
+        if stop is not None:
+            stop.set()
+        if process is not None:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def threaded(iterable, maxsize=QUEUE_SIZE, batch_size=1):
+    '''Starts draining an iterable in a background thread
+
+       Returns an iterator over the items of the iterable. The thread
+       stops early if that iterator is closed before it is exhausted.
+    '''
+    queue = Queue(maxsize)
+    stop = threading.Event()
+    thread = threading.Thread(target=_produce,
+                              args=(iterable, queue, stop, batch_size),
+                              daemon=True)
+    thread.start()
+    return _consume(queue, stop)
+
+
+def _run_in_process(func, in_queue, out_queue, batch_size):
+    stop = threading.Event()
+    _produce(func(_consume(in_queue)), out_queue, stop, batch_size)
+
+
+def in_process(func, iterable, maxsize=QUEUE_SIZE, batch_size=256):
+    '''Applies a function from one iterator to another (e.g. a
+       network's normalize function) in a separate process
+
+       The items of the iterable are fed to the process from a
+       background thread, and the process sends back the items of
+       func(iterator). The items must be picklable, and so must the
+       function unless processes are forked.
+    '''
+    ctx = multiprocessing.get_context()
+    in_queue = ctx.Queue(maxsize)
+    out_queue = ctx.Queue(maxsize)
+    stop = threading.Event()
+
+    process = ctx.Process(target=_run_in_process,
+                          args=(func, in_queue, out_queue, batch_size),
+                          daemon=True)
+    process.start()
+    feeder = threading.Thread(target=_produce,
+                              args=(iterable, in_queue, stop, batch_size),
+                              daemon=True)
+    feeder.start()
+    return _consume(out_queue, stop, process)
+
+
+def parallel_map(func, iterable, workers, ordered=True, max_pending=None):
+    '''Applies a function to each item of an iterable in a pool of
+       worker processes, and yields the results
+
+       Results are yielded in the order of the items or, if ordered is
+       False, as soon as each one is ready. The iterable is consumed
+       lazily, with at most max_pending (by default twice the number of
+       workers) items in flight at once. The function, items and
+       results must be picklable.
+    '''
+    if max_pending is None:
+        max_pending = workers * 2
+
+    with ProcessPoolExecutor(workers) as executor:
+        futures = (executor.submit(func, item) for item in iterable)
+        if ordered:
+            pending = deque()
+            for future in futures:
+                pending.append(future)
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        else:
+            pending = set()
+            for future in futures:
+                pending.add(future)
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending,
+                                         return_when=FIRST_COMPLETED)
+                    for f in done:
+                        yield f.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    yield f.result()
@@ -1,114 +1,194 @@
 # Standard module
-import pytz
 import logging
+from io import BytesIO
+from functools import lru_cache, partial
 
 # Installed libraries
-from lxml.etree import parse, XSLT
-from dateutil.parser import parse as dateparse
+from lxml.etree import parse, XSLT, XPath
 
 # Local
 from pkg_resources import resource_stream
 from crmprtd import Row
-from crmprtd.ec import ns, OmMember, no_ns_element
+from crmprtd.rowbatch import RowBatch
+from crmprtd.timeparse import parse_utc
+from crmprtd.ec import ns, no_ns_element
 from crmprtd.ec_swob.download import split_multi_xml_stream
+from crmprtd.stages import parallel_map
 
 
 log = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=None)
+def get_transform():
+    '''Returns the compiled ec_xform.xsl transform'''
+    return XSLT(parse(resource_stream('crmprtd', 'data/ec_xform.xsl')))
+
+
 def parse_xml(stream, xsl=None):
-    if xsl is None:
-        xsl = resource_stream('crmprtd', 'data/ec_xform.xsl')
+    transform = get_transform() if xsl is None else XSLT(parse(xsl))
 
     # Parse and transform the xml
     et = parse(stream)
-    transform = XSLT(parse(xsl))
     return transform(et)
 
 
+# XPath expressions used by normalize_xml(), compiled once
+members_xpath = XPath('//om:member', namespaces=ns)
+result_elements_xpath = XPath(
+    './om:Observation/om:result/{}/{}'.format(
+        no_ns_element('elements'), no_ns_element('element')),
+    namespaces=ns)
+value_elements_xpath = XPath(
+    './om:Observation/om:result//{}'.format(no_ns_element('element')),
+    namespaces=ns)
+# Plain strings, since "smart" strings refer back to (and so keep alive)
+# the document that they came from
+station_id_xpath = XPath(
+    './/{}/{}[@name=$name]/@value'.format(
+        no_ns_element('identification-elements'), no_ns_element('element')),
+    namespaces=ns, smart_strings=False)
+pos_xpath = XPath('.//gml:pos', namespaces=ns)
+time_xpath = XPath('./om:Observation/om:samplingTime//gml:timePosition',
+                   namespaces=ns)
+
+
 def identity(x):
     return x
 
 
 def normalize(file_stream, network_name,
               station_id_attr='climate_station_number',
-              station_id_xform=identity):
+              station_id_xform=identity, workers=None, ordered=True):
+    '''Normalizes a stream of one or more concatenated SWOB-ML documents
+
+       If workers is given, the documents are normalized in parallel by
+       a pool of that many processes, and their rows are yielded in the
+       order of the documents or, if ordered is False, as soon as each
+       document is done. station_id_xform must then be picklable (e.g.
+       a module level function).
+    '''
+    docs = split_multi_xml_stream(file_stream)
+    if not workers:
+        for xml_file in docs:
+            yield from normalize_xml(xml_file, network_name,
+                                     station_id_attr, station_id_xform)
+        return
+
+    func = partial(normalize_document, network_name=network_name,
+                   station_id_attr=station_id_attr,
+                   station_id_xform=station_id_xform)
+    for rows in parallel_map(func, (doc.getvalue() for doc in docs),
+                             workers, ordered):
+        yield from rows
+
+
+def normalize_batches(file_stream, network_name,
+                      station_id_attr='climate_station_number',
+                      station_id_xform=identity, batch_size=None):
+    '''Normalizes a stream of one or more concatenated SWOB-ML documents
+       into RowBatches of at most batch_size rows (or a single RowBatch
+       if batch_size is None)
+
+       Each observation is appended straight to the columns of a batch,
+       without building a Row for it.
+    '''
+    batch = RowBatch()
     for xml_file in split_multi_xml_stream(file_stream):
-        yield from normalize_xml(xml_file, network_name, station_id_attr,
-                                 station_id_xform)
+        normalize_xml_into(batch.append, xml_file, network_name,
+                           station_id_attr, station_id_xform)
+        while batch_size is not None and len(batch) >= batch_size:
+            full, batch = batch.split(batch_size)
+            yield full
+    if len(batch) or batch_size is None:
+        yield batch
+
+
+def normalize_document(doc, network_name,
+                       station_id_attr='climate_station_number',
+                       station_id_xform=identity):
+    '''Normalizes a single SWOB-ML document given as bytes, returning a
+       list of rows (for use in a worker process)
+    '''
+    return list(normalize_xml(BytesIO(doc), network_name, station_id_attr,
+                              station_id_xform))
 
 
 def normalize_xml(file_stream, network_name,
                   station_id_attr='climate_station_number',
                   station_id_xform=identity):
+    rows = []
+
+    def append(*fields):
+        rows.append(Row(*fields))
+
+    normalize_xml_into(append, file_stream, network_name, station_id_attr,
+                       station_id_xform)
+    yield from rows
+
+
+def normalize_xml_into(append, file_stream, network_name,
+                       station_id_attr='climate_station_number',
+                       station_id_xform=identity):
+    '''Normalizes a single SWOB-ML document, calling append() with the
+       fields of each row (in the order of Row's fields)
+    '''
     et = parse_xml(file_stream)
 
-    members = et.xpath('//om:member', namespaces=ns)
     log.info('Starting %s data normalization', network_name)
 
-    for member in members:
-        om = OmMember(member)
-        vars = om.observed_vars()
+    for member in members_xpath(et):
+        # Collect the observed variables and their units and values in a
+        # single pass over the member's elements
+        elements = result_elements_xpath(member)
+        vars = [e.get('name') for e in elements
+                if e.get('name') and e.get('value')]
+        if not vars:
+            continue
+
+        units = {}
+        for e in elements:
+            units.setdefault(e.get('name'), e.get('uom'))
+        values = {}
+        for e in value_elements_xpath(member):
+            values.setdefault(e.get('name'), e.get('value'))
+
+        try:
+            log.debug("Finding Station attributes")
+            station_id = station_id_xform(
+                station_id_xpath(member, name=station_id_attr)[0])
+            lat, lon = map(float, pos_xpath(member)[0].text.split())
+            obs_time = time_xpath(member)[0].text
+            log.debug('Found station info',
+                      extra={'station_id': station_id,
+                             'lon': lon,
+                             'lat': lat,
+                             'time': obs_time})
+        # An IndexError here means that the member has no station_name or
+        # climate_station_number (or identification-elements), lat/lon,
+        # or obs_time in which case we don't need to process this item
+        except IndexError:
+            log.warning("This member does not appear to be a station")
+            continue
+
+        try:
+            date = parse_utc(obs_time)
+        except ValueError as e:
+            log.error('Unable to parse date', extra={'exception': e})
+            continue
 
         for var in vars:
-            try:
-                ele = om.member.xpath(
-                        "./om:Observation/om:result//"
-                        "{}[@name='{}']".format(
-                            no_ns_element('element'), var
-                        ), namespaces=ns)[0]
-                val = ele.get('value')
-                # Ignore missing values. We don't record them.
-                if val == 'MSNG':
-                    log.debug('Ignoring missing obs with value \'MSNG\'')
-                    continue
-                val = float(val)
-            # This shouldn't ever be empty based on our xpath for selecting
-            # elements, however it could be non-numeric and
-            # still be valid XML
-            except ValueError as e:
-                log.error('Unable to convert value',
-                          extra={'val': (ele.get('value'))})
-                continue
-
-            try:
-                log.debug("Finding Station attributes")
-                station_id = member.xpath(
-                    ".//{}/{}[@name='{}']".format(
-                        no_ns_element('identification-elements'),
-                        no_ns_element('element'),
-                        station_id_attr
-                    ), namespaces=ns)[0].get('value')
-                station_id = station_id_xform(station_id)
-
-                lat, lon = map(float, member.xpath(
-                    './/gml:pos', namespaces=ns)[0].text.split())
-                obs_time = member.xpath(
-                    './om:Observation/om:samplingTime//gml:timePosition',
-                    namespaces=ns)[0].text
-                log.debug('Found station info',
-                          extra={'station_id': station_id,
-                                 'lon': lon,
-                                 'lat': lat,
-                                 'time': obs_time})
-            # An IndexError here means that the member has no station_name or
-            # climate_station_number (or identification-elements), lat/lon,
-            # or obs_time in which case we don't need to process this item
-            except IndexError:
-                log.warning("This member does not appear to be a station")
+            val = values[var]
+            # Ignore missing values. We don't record them.
+            if val == 'MSNG':
+                log.debug('Ignoring missing obs with value \'MSNG\'')
                 continue
-
+            # This could be non-numeric and still be valid XML
             try:
-                date = dateparse(obs_time).astimezone(pytz.utc)
-            except ValueError as e:
-                log.error('Unable to parse date', extra={'exception': e})
+                val = float(val)
+            except ValueError:
+                log.error('Unable to convert value', extra={'val': val})
                 continue
 
-            yield Row(time=date,
-                      val=val,
-                      variable_name=var,
-                      unit=om.member_unit(var),
-                      network_name=network_name,
-                      station_id=station_id,
-                      lat=lat,
-                      lon=lon)
+            append(date, val, var, units[var], network_name, station_id,
+                   lat, lon)
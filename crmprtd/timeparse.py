@@ -0,0 +1,66 @@
+"""timeparse.py
+The timeparse module converts the time strings found in the networks'
+data to timezone aware UTC datetimes for the Normalize phase.
+
+The same time string typically occurs many times in a file (once per
+station or variable observed at that time), so results are memoized by
+the raw string and time zone. Strings in a known format are parsed with
+strptime() or datetime.fromisoformat(), and only the rest are handed to
+dateutil's much slower general parser.
+"""
+
+from datetime import datetime
+from functools import lru_cache
+
+import pytz
+from dateutil.parser import parse as dateparse
+
+
+# Number of distinct time strings remembered by each parser
+CACHE_SIZE = 4096
+PACIFIC = 'Canada/Pacific'
+
+# Not available before Python 3.7
+fromisoformat = getattr(datetime, 'fromisoformat', None)
+
+
+@lru_cache(maxsize=None)
+def get_timezone(name):
+    return pytz.timezone(name)
+
+
+def parse_datetime(string, fmt=None):
+    '''Parses a time string with strptime() if a format is given, or
+       otherwise with fromisoformat() or, failing that, dateutil
+    '''
+    if fmt is not None:
+        return datetime.strptime(string, fmt)
+    if fromisoformat is not None:
+        try:
+            return fromisoformat(string)
+        except ValueError:
+            pass
+    return dateparse(string)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_local(string, fmt=None, tz_name=PACIFIC):
+    '''Parses a time string without zone information, which is local time
+       in the named time zone, and returns an aware UTC datetime
+
+       Ambiguous and non-existent local times (around DST transitions)
+       are treated as standard time, as pytz's localize() does by
+       default. Raises ValueError if the string can not be parsed.
+    '''
+    tz = get_timezone(tz_name)
+    return tz.localize(parse_datetime(string, fmt)).astimezone(pytz.utc)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_utc(string):
+    '''Parses a time string with zone information (e.g. an ISO 8601
+       string with an offset or "Z") and returns an aware UTC datetime
+
+       Raises ValueError if the string can not be parsed.
+    '''
+    return parse_datetime(string).astimezone(pytz.utc)
@@ -1,19 +1,20 @@
 # Standard libraries
-import io
 import logging
-import re
 import csv
 
-# Installed libraries
-import pytz
-from dateutil.parser import parse
-
 # Local
 from crmprtd import Row
+from crmprtd.timeparse import parse_local
 
 
 log = logging.getLogger(__name__)
 
+UNIT_SUBSTITUTIONS = {
+    '% RH': '%',
+    '\u00b0C': 'celsius',
+    'mb': 'millibar',
+}
+
 
 def get_one_of(elements):
     for e in elements:
@@ -22,17 +23,40 @@ def get_one_of(elements):
     raise ValueError(f"No elements of {e} have a truthy value")
 
 
+def column_getter(header, name):
+    '''Returns a function which gets the named column from a row of
+       the CSV file, or None if the file (or row) doesn't have it
+    '''
+    try:
+        i = header.index(name)
+    except ValueError:
+        return lambda row: None
+    return lambda row: row[i] if i < len(row) else None
+
+
 def normalize(file_stream):
     log.info('Starting WAMR data normalization')
 
-    string_stream = io.StringIO(file_stream.read().decode('utf-8'))
-    reader = csv.DictReader(string_stream)
+    # Decode and parse line by line, so that memory use doesn't grow with
+    # the size of the file
+    lines = (line.decode('utf-8') for line in file_stream)
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+
+    keys_of_interest = ('DATE_PST', 'STATION_NAME', 'UNIT', 'UNITS',
+                        'PARAMETER', 'REPORTED_VALUE',
+                        'LONGITUDE', 'LATITUDE')
+    getters = [column_getter(header, k) for k in keys_of_interest]
+
     for row in reader:
-        keys_of_interest = ('DATE_PST', 'STATION_NAME', 'UNIT', 'UNITS',
-                            'PARAMETER', 'REPORTED_VALUE',
-                            'LONGITUDE', 'LATITUDE')
+        # Skip blank lines
+        if not row:
+            continue
+
         time, station_id, unit, units, variable_name, val, lon, lat = (
-            row[k] if k in row else None for k in keys_of_interest)
+            get(row) for get in getters)
 
         # skip over empty values
         if val == '':
@@ -50,27 +74,19 @@ def normalize(file_stream):
             continue
 
         try:
-            tz = pytz.timezone('Canada/Pacific')
             # Timezone information is not available from the text
             # string provided. However, the date field in WAMR's feed
             # is always titled "DATE_PST" (even during times of
             # DST). There's not really enough information available
             # from the network, so we'll have to assume that this
             # covers it.
-            dt = tz.localize(parse(time)).astimezone(pytz.utc)
+            dt = parse_local(time)
         except ValueError:
             log.error('Unable to convert date string to datetime',
                       extra={'time': time})
             continue
 
-        substitutions = [
-            ('% RH', '%'),
-            ('\u00b0C', 'celsius'),
-            ('mb', 'millibar'),
-        ]
-        for src, dest in substitutions:
-            if unit == src:
-                unit = re.sub(src, dest, unit)
+        unit = UNIT_SUBSTITUTIONS.get(unit, unit)
 
         yield Row(time=dt,
                   val=value,
@@ -1,73 +1,139 @@
-# Installed libraries
-import pytz
 import logging
-from datetime import datetime
+from functools import partial
+from itertools import islice
 
 # Local
 from crmprtd import Row
+from crmprtd.rowbatch import RowBatch
+from crmprtd.timeparse import parse_local
+from crmprtd.stages import parallel_map
 
 
 log = logging.getLogger(__name__)
 
 
-def normalize(file_stream):
-    log.info('Starting WMB data normalization')
+# Number of lines normalized at a time by each worker process
+CHUNK_SIZE = 2000
+
+
+def clean_row(row):
+    return row.strip().replace('"', '').split(',')
+
 
-    def clean_row(row):
-        return row.strip().replace('"', '').split(',')
+def normalize(file_stream, workers=None, chunk_size=CHUNK_SIZE):
+    '''Normalizes a WMB hourly CSV file
+
+       If workers is given, the lines after the header are split into
+       chunks of chunk_size lines which are normalized in parallel by a
+       pool of that many processes. Rows are yielded in the same order
+       either way.
+    '''
+    log.info('Starting WMB data normalization')
 
     # set variable names using first row in file stream
-    var_names = []
+    header = None
     for first_row in file_stream:
-        first_row = first_row.decode('utf-8')
-        for var in clean_row(first_row):
-            var_names.append(var)
+        header = first_row.decode('utf-8')
         break
+    if header is None:
+        return
+
+    if not workers:
+        yield from normalize_lines(header, file_stream)
+        return
 
-    for row in file_stream:
-        row = row.decode('utf-8')
-        # assign variable name to value
-        data = [(var_name, value)
-                for var_name, value in zip(var_names, clean_row(row))]
+    chunks = iter(lambda: list(islice(file_stream, chunk_size)), [])
+    for rows in parallel_map(partial(normalize_chunk, header), chunks,
+                             workers):
+        yield from rows
+
+
+def normalize_batches(file_stream, batch_size=None):
+    '''Normalizes a WMB hourly CSV file into RowBatches of at most
+       batch_size rows (or a single RowBatch if batch_size is None)
+
+       Each observation is appended straight to the columns of a batch,
+       without building a Row for it.
+    '''
+    log.info('Starting WMB data normalization')
+
+    header = None
+    for first_row in file_stream:
+        header = first_row.decode('utf-8')
+        break
+    if header is None:
+        return
 
-        # extract station_id and weather_date from list
-        _, station_id = data.pop(0)
-        _, weather_date = data.pop(0)
+    var_names = clean_row(header)
+    batch = RowBatch()
+    for line in file_stream:
+        normalize_line(batch.append, var_names, line)
+        while batch_size is not None and len(batch) >= batch_size:
+            full, batch = batch.split(batch_size)
+            yield full
+    if len(batch) or batch_size is None:
+        yield batch
+
+
+def normalize_chunk(header, lines):
+    '''Normalizes a list of lines, returning a list of rows (for use in
+       a worker process)
+    '''
+    return list(normalize_lines(header, lines))
+
+
+def normalize_lines(header, lines):
+    var_names = clean_row(header)
+    rows = []
+
+    def append(*fields):
+        rows.append(Row(*fields))
+
+    for line in lines:
+        normalize_line(append, var_names, line)
+        yield from rows
+        rows.clear()
+
+
+def normalize_line(append, var_names, line):
+    '''Normalizes one line of a WMB hourly CSV file, calling append()
+       with the fields of each row (in the order of Row's fields)
+    '''
+    values = clean_row(line.decode('utf-8'))
+
+    # The first two columns are the station_id and weather_date. The
+    # rest are variables.
+    station_id = values[0]
+    weather_date = values[1]
+    num_columns = min(len(var_names), len(values))
+
+    # The date's provided are in 1-24 hour format *roll*
+    hour = int(weather_date[-2:]) - 1
+    weather_date = weather_date[:-2] + str(hour)
+    try:
+        # Timezone information isn't provided by WMB, but the
+        # observations appear to be in local time. The max time
+        # value found in a request is the most recent hour local
+        # time. Hopefully assuming this will suffice.
+        date = parse_local(weather_date, "%Y%m%d%H")
+    except ValueError:
+        log.error('Unable to convert date', extra={'date': weather_date})
+        return
+
+    for i in range(2, num_columns):
+        var_name = var_names[i]
+        value = values[i]
+
+        # skip if value string is empty
+        if not value:
+            continue
 
-        tz = pytz.timezone('Canada/Pacific')
-        # The date's provided are in 1-24 hour format *roll*
-        hour = int(weather_date[-2:]) - 1
-        weather_date = weather_date[:-2] + str(hour)
         try:
-            # Timezone information isn't provided by WMB, but the
-            # observations appear to be in local time. The max time
-            # value found in a request is the most recent hour local
-            # time. Hopefully assuming this will suffice.
-            date = datetime.strptime(weather_date, "%Y%m%d%H")
-            date = tz.localize(date).astimezone(pytz.utc)
+            value = float(value)
         except ValueError:
-            log.error('Unable to convert date', extra={'date': weather_date})
+            log.error('Unable to convert val to float',
+                      extra={'value': value})
             continue
 
-        for pair in data:
-            var_name, value = pair
-
-            # skip if value string is empty
-            if not value:
-                continue
-
-            try:
-                value = float(value)
-            except ValueError:
-                log.error('Unable to convert val to float',
-                          extra={'value': value})
-                continue
-
-            yield Row(time=date,
-                      val=value,
-                      variable_name=var_name,
-                      unit=None,
-                      network_name='FLNRO-WMB',
-                      station_id=station_id,
-                      lat=None,
-                      lon=None)
+        append(date, value, var_name, None, 'FLNRO-WMB', station_id, None,
+               None)
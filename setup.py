@@ -46,6 +46,8 @@ setup(
             'download_moti=crmprtd.moti.download:main',
             'download_wamr=crmprtd.wamr.download:main',
             'download_wmb=crmprtd.wmb.download:main',
+            'crmprtd_normalize=crmprtd.normalize:main',
+            'crmprtd_create_indexes=crmprtd.create_indexes:main',
             'crmprtd_process=crmprtd.process:main',
             'crmprtd_infill_all=scripts.infill_all:main'
         ]
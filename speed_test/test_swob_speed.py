@@ -0,0 +1,64 @@
+import timeit
+from io import BytesIO
+from argparse import ArgumentParser
+from statistics import mean
+
+from crmprtd.ec_swob.download import split_multi_xml_stream
+from crmprtd.swob_ml import normalize_xml
+from speed_test.trial_swob_normalize import normalize_xml as \
+    trial_normalize_xml
+
+
+def read_documents(fname, copies):
+    with open(fname, 'rb') as f:
+        docs = [doc.getvalue() for doc in split_multi_xml_stream(f)]
+    return docs * copies
+
+
+def normalize_all(func, docs, station_id_attr):
+    return [row for doc in docs
+            for row in func(BytesIO(doc), 'test', station_id_attr)]
+
+
+def time_test(func, docs, station_id_attr, num_iter):
+    return timeit.repeat(
+        lambda: normalize_all(func, docs, station_id_attr),
+        repeat=num_iter, number=1)
+
+
+def report(name, times, num_docs, num_rows):
+    r_mean = mean(times)
+    print('{}'.format(name))
+    print('\tMean:\t{}s'.format(round(r_mean, 3)))
+    print('\tMin:\t{}s'.format(round(min(times), 3)))
+    print('\tDocuments/s:\t{}'.format(round(num_docs / r_mean, 1)))
+    print('\tRows/s:\t\t{}'.format(round(num_rows / r_mean, 1)))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description='Compare the throughput of the current SWOB-ML '
+                    'normalizer with the original one')
+    parser.add_argument('-f', '--filename', required=True,
+                        help='File of one or more concatenated SWOB-ML '
+                             'documents (e.g. the output of a SWOB download '
+                             'script)')
+    parser.add_argument('-s', '--station_id_attr', default='msc_id',
+                        help='Name of the element holding the station id')
+    parser.add_argument('-c', '--copies', type=int, default=1,
+                        help='Number of times to repeat the documents')
+    parser.add_argument('-t', '--iterations', type=int, default=5,
+                        help='Number of times the testing code will be run')
+    args = parser.parse_args()
+
+    docs = read_documents(args.filename, args.copies)
+    rows = normalize_all(normalize_xml, docs, args.station_id_attr)
+    trial_rows = normalize_all(trial_normalize_xml, docs,
+                               args.station_id_attr)
+    assert rows == trial_rows, 'The normalizers disagree'
+
+    print('{} documents, {} rows'.format(len(docs), len(rows)))
+    for name, func in (('Original', trial_normalize_xml),
+                       ('Compiled', normalize_xml)):
+        times = time_test(func, docs, args.station_id_attr, args.iterations)
+        report(name, times, len(docs), len(rows))
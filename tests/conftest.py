@@ -157,6 +157,17 @@ def test_data():
     return data
 
 
+@pytest.fixture(scope='function')
+def wmb_data():
+    '''A WMB file of 3 stations x 24 hours x 3 variables (216 rows once
+       normalized)
+    '''
+    header = b'station_code,weather_date,precipitation,temperature,humidity\n'
+    return header + b''.join(
+        b'%d,20180527%02d,.00,%d.2,55\n' % (stn, hour, hour)
+        for stn in range(1, 4) for hour in range(1, 25))
+
+
 @pytest.yield_fixture(scope='function')
 def ec_session(crmp_session, caplog):
     '''
@@ -1,11 +1,16 @@
 import pytest
+import pytz
 from datetime import datetime
 from geoalchemy2.functions import ST_X, ST_Y
 
 from crmprtd.align import is_network, get_history, get_variable, unit_check, \
-    align, closest_stns_within_threshold, convert_unit
+    align, closest_stns_within_threshold, convert_unit, Aligner, \
+    align_batch, convert_units, get_conversion_plan, \
+    closest_histories_within_threshold, create_history_geography_index, \
+    create_stations_and_histories, ObsRecord, get_aligner
 from crmprtd import Row
-from pycds import Station, History
+from crmprtd.rowbatch import RowBatch
+from pycds import Station, History, Network
 
 
 @pytest.mark.parametrize(('network_name', 'expected'), [
@@ -16,6 +21,242 @@ def test_is_network(test_session, network_name, expected):
     assert is_network(test_session, network_name) == expected
 
 
+def test_aligner_metadata_cache(test_session):
+    aligner = Aligner(test_session)
+    assert aligner.is_network('FLNRO-WMB')
+    assert not aligner.is_network('WMB')
+    assert aligner.get_variable('FLNRO-WMB', 'relative_humidity').id == 3
+    assert aligner.get_variable('FLNRO-WMB', 'humidity') is None
+    assert aligner.cache_stats() == {'hits': 2, 'misses': 2}
+
+
+def test_aligner_align(test_session):
+    obs_tuple = Row(time=datetime(2012, 9, 26, 18),
+                    val=10,
+                    variable_name='precipitation',
+                    unit='cm',
+                    network_name='EC_raw',
+                    station_id='1047172',
+                    lat=49.45,
+                    lon=-123.7)
+    aligner = Aligner(test_session)
+    ob = aligner.align(obs_tuple)
+    assert ob.history_id == 20
+    assert ob.vars_id == 2
+    assert ob.datum == 100
+    assert aligner.cache_stats()['hits'] == 2
+
+
+def test_align_records(test_session):
+    obs_tuple = Row(time=datetime(2012, 9, 26, 18),
+                    val=10,
+                    variable_name='precipitation',
+                    unit='cm',
+                    network_name='EC_raw',
+                    station_id='1047172',
+                    lat=49.45,
+                    lon=-123.7)
+    ob = align(test_session, obs_tuple, records=True)
+    assert ob == ObsRecord(history_id=20, vars_id=2,
+                           time=datetime(2012, 9, 26, 18), datum=100)
+
+
+def test_align_reuses_aligner(test_session, mocker):
+    obs_tuple = Row(time=datetime(2012, 9, 26, 18),
+                    val=10,
+                    variable_name='precipitation',
+                    unit='cm',
+                    network_name='EC_raw',
+                    station_id='1047172',
+                    lat=49.45,
+                    lon=-123.7)
+    load = mocker.spy(Aligner, 'load')
+    for _ in range(3):
+        align(test_session, obs_tuple)
+    assert load.call_count == 1
+    assert get_aligner(test_session) is get_aligner(test_session)
+    assert get_aligner(test_session, records=True) is not \
+        get_aligner(test_session)
+
+
+def test_align_batch(test_session):
+    rows = [
+        Row(time=datetime(2012, 9, 26, hour),
+            val=10,
+            variable_name='CURRENT_AIR_TEMPERATURE1',
+            unit='celsius',
+            network_name='MoTIe',
+            station_id=station_id,
+            lat=None,
+            lon=None)
+        for hour in range(6) for station_id in ('11091', '666')
+    ]
+    observations = align_batch(test_session, rows)
+    assert len(observations) == 12
+    assert {ob.history_id for ob in observations} == {1, 5}
+
+    # A single new station is created for all of the observations
+    q = test_session.query(Station)
+    assert q.count() == 7
+
+
+def test_align_row_batch(test_session):
+    rows = [
+        Row(time=datetime(2012, 9, 26, hour, tzinfo=pytz.utc),
+            val=10,
+            variable_name='CURRENT_AIR_TEMPERATURE1',
+            unit='celsius',
+            network_name='MoTIe',
+            station_id=station_id,
+            lat=None,
+            lon=None)
+        for hour in range(6) for station_id in ('11091', '666')
+    ]
+    # Rows which can not be aligned are dropped
+    rows.append(Row(None, 10, 'CURRENT_AIR_TEMPERATURE1', 'celsius',
+                    'MoTIe', '11091', None, None))
+    rows.append(Row(datetime(2012, 9, 26, tzinfo=pytz.utc), 10,
+                    'CURRENT_AIR_TEMPERATURE1', 'celsius', 'WMB', '11091',
+                    None, None))
+    aligner = Aligner(test_session, records=True)
+    observations = aligner.align_batch(RowBatch(rows))
+    assert len(observations) == 12
+    assert observations == aligner.align_batch(rows[:12])
+
+    # pycds.Obs objects compare by identity, so compare their fields
+    def fields(ob):
+        return (ob.history_id, ob.vars_id, ob.time, ob.datum)
+
+    aligner = Aligner(test_session)
+    assert [fields(ob) for ob in aligner.align_batch(RowBatch(rows))] == \
+        [fields(ob) for ob in observations]
+
+
+def test_aligner_resolves_each_history_once(test_session, mocker):
+    rows = [
+        Row(time=datetime(2012, 9, 26, hour),
+            val=123,
+            variable_name='precipitation',
+            unit='mm',
+            network_name='EC_raw',
+            station_id='1047172',
+            lat=None,
+            lon=None)
+        for hour in range(24)
+    ]
+    aligner = Aligner(test_session)
+    match_history = mocker.spy(aligner, 'match_history')
+    observations = aligner.align_batch(rows)
+    observations += aligner.align_batch(rows)
+    assert len(observations) == 48
+    assert {ob.history_id for ob in observations} == {21}
+    assert match_history.call_count == 1
+
+
+def test_create_stations_and_histories(test_session):
+    history_ids = create_stations_and_histories(
+        test_session, [(1, '666', 49, -121), (1, '667', None, None)])
+    assert len(history_ids) == 2
+
+    q = test_session.query(Station)
+    assert q.count() == 8
+
+    histories = [test_session.query(History).get(history_id)
+                 for history_id in history_ids]
+    assert [(h.station.native_id, h.lat) for h in histories] == \
+        [('666', 49), ('667', None)]
+
+
+def test_aligner_fetch_histories_null_native_id(test_session):
+    moti = test_session.query(Network).filter_by(name='MoTIe').one()
+    history = History(station_name='Unnamed', lat=49, lon=-121)
+    test_session.add(Station(native_id=None, network=moti,
+                             histories=[history]))
+    test_session.flush()
+
+    aligner = Aligner(test_session)
+    histories = aligner.fetch_histories({('MoTIe', None), ('MoTIe', '11091')})
+    assert [h.id for h in histories[('MoTIe', None)]] == [history.id]
+    assert [h.id for h in histories[('MoTIe', '11091')]] == [1]
+
+
+def test_aligner_create_histories_reuses_existing_station(test_session):
+    # Simulate a station which was created by a concurrent run after the
+    # batch was resolved
+    aligner = Aligner(test_session)
+    aligner.load()
+    key = ('MoTIe', '11091', None, None)
+    aligner.create_histories({key[:2]: [key]})
+    assert aligner.histories[key] == 1
+
+    q = test_session.query(Station)
+    assert q.count() == 6
+
+
+def test_aligner_create_histories_rechecks_located_stations(ec_session):
+    # A station at a location that a concurrent run has already created
+    # a history for, after the batch was resolved
+    aligner = Aligner(ec_session)
+    aligner.load()
+    key = ('EC_raw', '1047172', 49.45, -123.7)
+    num_stations = ec_session.query(Station).count()
+    aligner.create_histories({key: [key]})
+    assert aligner.histories[key] == 20000
+    assert ec_session.query(Station).count() == num_stations
+
+
+def test_aligner_snapshot(test_session, tmpdir):
+    snapshot = str(tmpdir.join('snapshot.pickle'))
+    rows = [
+        Row(time=datetime(2012, 9, 26, 18),
+            val=10,
+            variable_name=variable_name,
+            unit=None,
+            network_name=network_name,
+            station_id=station_id,
+            lat=None,
+            lon=None)
+        for network_name, station_id, variable_name in (
+            ('MoTIe', '11091', 'CURRENT_AIR_TEMPERATURE1'),
+            ('EC_raw', '1047172', 'precipitation'),
+        )
+    ]
+    aligner = Aligner(test_session)
+    aligner.load_snapshot(snapshot)
+    aligner.align_batch(rows)
+    aligner.save_snapshot(snapshot)
+
+    # Nothing has changed, so everything is reused
+    warm = Aligner(test_session)
+    warm.load_snapshot(snapshot)
+    assert warm.networks == aligner.networks
+    assert warm.variables == aligner.variables
+    assert warm.histories == aligner.histories
+
+    # A new history for one station only invalidates that station
+    station = test_session.query(Station).filter_by(native_id='11091').one()
+    test_session.add(History(id=20000, station=station,
+                             station_name='Brandywine 2'))
+    test_session.commit()
+
+    refreshed = Aligner(test_session)
+    refreshed.load_snapshot(snapshot)
+    assert refreshed.networks == aligner.networks
+    assert refreshed.histories == {('EC_raw', '1047172', None, None): 21}
+
+
+def test_aligner_snapshot_missing_or_corrupt(test_session, tmpdir):
+    aligner = Aligner(test_session)
+    aligner.load_snapshot(str(tmpdir.join('missing.pickle')))
+    assert aligner.networks is None
+
+    corrupt = tmpdir.join('corrupt.pickle')
+    corrupt.write('not a pickle')
+    aligner.load_snapshot(str(corrupt))
+    assert aligner.networks is None
+    assert aligner.histories == {}
+
+
 def test_get_history_with_no_matches(test_session):
     # this observation will not match any in test session
     obs_tuple = Row(time=datetime.now(),
@@ -140,7 +381,7 @@ def test_unit_check(test_session, network_name, variable_name, unit,
          station_id='11091',
          lat=None,
          lon=None), 1, datetime(2012, 9, 26, 18), 1, 10),
-    # use create_station_and_history_entry for unrecognized station_id
+    # create a new station and history for unrecognized station_id
     (Row(time=datetime(2012, 9, 26, 18),
          val=10,
          variable_name='CURRENT_AIR_TEMPERATURE1',
@@ -255,6 +496,27 @@ def test_closest_stns_within_threshold_bad_data(ec_session):
     assert len(x) > 0
 
 
+def test_closest_histories_within_threshold(ec_session):
+    sechelt = ('EC_raw', '1047172', 49.45, -123.7)
+    stewart = ('EC_raw', '1067742', 55.9361111111111, -129.985)
+    nowhere = ('EC_raw', '1067742', 51, -128)
+    elsewhere = ('MoTIe', '1067742', 55.9361111111111, -129.985)
+
+    create_history_geography_index(ec_session)
+    nearby = closest_histories_within_threshold(
+        ec_session, [sechelt, stewart, nowhere, elsewhere], 2000)
+
+    # Nearest first
+    assert nearby[sechelt] == [20000, 20001]
+    assert nearby[stewart] == [10001]
+    assert nearby[nowhere] == []
+    assert nearby[elsewhere] == []
+
+
+def test_closest_histories_within_threshold_no_keys(ec_session):
+    assert closest_histories_within_threshold(ec_session, [], 800) == {}
+
+
 @pytest.mark.parametrize(('alias', 'dest'), (
     ('Deg.', 'degree'),
     ('Deg', 'degree'),
@@ -264,3 +526,28 @@ def test_closest_stns_within_threshold_bad_data(ec_session):
 def test_convert_unit(alias, dest):
     x = 42
     assert convert_unit(x, alias, dest) == x
+
+
+@pytest.mark.parametrize(('src', 'dst', 'val', 'expected'), (
+    ('cm', 'mm', 10, 100),
+    ('millibar', 'kPa', 1000, 100),
+    ('celsius', 'degF', 100, 212),
+    ('degF', 'celsius', 32, 0),
+))
+def test_conversion_plan(src, dst, val, expected):
+    plan = get_conversion_plan(src, dst)
+    assert plan.convert(val) == pytest.approx(expected, abs=1e-6)
+    assert convert_unit(val, src, dst) == pytest.approx(expected, abs=1e-6)
+    assert get_conversion_plan(src, dst) is plan
+
+
+def test_conversion_plan_not_convertible():
+    assert get_conversion_plan('km', 'celsius') is None
+    assert convert_unit(42, 'km', 'celsius') is None
+    assert convert_units([42], 'km', 'celsius') is None
+
+
+def test_convert_units():
+    assert convert_units([1, 2.5, -3], 'cm', 'mm') == \
+        pytest.approx([10, 25, -30])
+    assert convert_units((1, 2), 'mm', 'mm') == [1, 2]
@@ -1,6 +1,8 @@
+import codecs
 from io import BytesIO
 import datetime
 
+import pytest
 import pytz
 
 from crmprtd.crd.normalize import normalize
@@ -41,3 +43,47 @@ def test_normalize_good_data():
         assert row.station_id == "14g"
         assert row.variable_name in ("Rain", "Precipitation")
         assert row.time == tz.localize(datetime.datetime(2020, 3, 16, 11))
+
+
+def crd_response(num_records, header_first=True):
+    header = '"HEADER": {"_units": {"RainUnit": "millimetre"}}'
+    data = '"DATA": [{}]'.format(', '.join(
+        '{{"StationName": "14g", "DateTimeString": "202003161{}0000", '
+        '"Rain": {}}}'.format(i, i) for i in range(num_records)))
+    parts = [header, data] if header_first else [data, header]
+    return '{{{}, "ERROR": ""}}'.format(', '.join(parts)).encode('utf-8')
+
+
+@pytest.mark.parametrize('header_first', [True, False])
+@pytest.mark.parametrize('chunk_size', [1, 16, 2 ** 16])
+def test_normalize_stream(header_first, chunk_size):
+    rows = list(normalize(BytesIO(crd_response(5, header_first)),
+                          chunk_size))
+    assert [row.val for row in rows] == [0, 1, 2, 3, 4]
+    assert all(row.unit == 'millimetre' for row in rows)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 2 ** 16])
+def test_normalize_byte_order_mark(chunk_size):
+    rows = list(normalize(BytesIO(codecs.BOM_UTF8 + crd_response(2)),
+                          chunk_size))
+    assert [row.val for row in rows] == [0, 1]
+
+
+def test_normalize_is_incremental():
+    class Stream(object):
+        def __init__(self, data):
+            self.data = BytesIO(data)
+
+        def read(self, size):
+            if self.data.tell() > 150:
+                raise AssertionError('Read past the first record')
+            return self.data.read(size)
+
+    rows = normalize(Stream(crd_response(100)), chunk_size=10)
+    assert next(rows).val == 0
+
+
+def test_normalize_missing_header():
+    with pytest.raises(KeyError):
+        list(normalize(BytesIO(b'{"DATA": []}')))
@@ -1,6 +1,7 @@
 import pytest
 
-from crmprtd import subset_dict
+from crmprtd import subset_dict, batched, write_through, run_data_pipeline, \
+    Row
 
 
 @pytest.mark.parametrize(('a_dict', 'keys', 'expected'), (
@@ -10,3 +11,135 @@ from crmprtd import subset_dict
 ))
 def test_subset_dict(a_dict, keys, expected):
     assert subset_dict(a_dict, keys) == expected
+
+
+@pytest.mark.parametrize(('batch_size', 'expected'), (
+    (None, [[0, 1, 2, 3, 4]]),
+    (2, [[0, 1], [2, 3], [4]]),
+    (5, [[0, 1, 2, 3, 4]]),
+    (10, [[0, 1, 2, 3, 4]]),
+))
+def test_batched(batch_size, expected):
+    assert list(batched(iter(range(5)), batch_size)) == expected
+
+
+def test_batched_is_lazy():
+    def items():
+        yield 1
+        raise AssertionError('Read past the first batch')
+
+    assert next(batched(items(), 1)) == [1]
+
+
+def test_write_through(tmpdir):
+    cache_file = str(tmpdir.join('cache'))
+    chunks = write_through(iter(['a', 'b', 'c']), cache_file)
+    # Each chunk is written to the cache as it is passed on
+    assert next(chunks) == 'a'
+    assert list(chunks) == ['b', 'c']
+    with open(cache_file) as f:
+        assert f.read() == 'abc'
+
+
+def test_write_through_error(tmpdir):
+    cache_file = tmpdir.join('cache')
+    cache_file.write('old')
+
+    def chunks():
+        yield 'a'
+        raise IOError('Connection lost')
+
+    with pytest.raises(IOError):
+        list(write_through(chunks(), str(cache_file)))
+    # The previous cache is left as is, with no partial file beside it
+    assert cache_file.read() == 'old'
+    assert tmpdir.listdir() == [cache_file]
+
+
+def test_write_through_not_exhausted(tmpdir):
+    cache_file = tmpdir.join('cache')
+    chunks = write_through(iter(['a', 'b']), str(cache_file))
+    assert next(chunks) == 'a'
+    chunks.close()
+    assert tmpdir.listdir() == []
+
+
+class FakeAligner(object):
+    '''Stands in for the Aligner, "aligning" rows to themselves'''
+
+    def __init__(self, sesh, *args, **kwargs):
+        pass
+
+    def align_batch(self, rows):
+        return list(rows)
+
+    def cache_stats(self):
+        return {}
+
+    def load_snapshot(self, path):
+        pass
+
+    def save_snapshot(self, path):
+        pass
+
+
+def download_lines(num_lines):
+    for i in range(num_lines):
+        yield '{}\n'.format(i)
+
+
+def normalize_lines(lines):
+    for line in lines:
+        yield Row(time=None, val=float(line), variable_name='x', unit=None,
+                  network_name='net', station_id='1', lat=None, lon=None)
+
+
+@pytest.mark.parametrize(('overlap', 'batch_size', 'num_batches'), (
+    (False, None, 1),
+    (False, 4, 3),
+    (True, None, 1),
+    (True, 4, 3),
+))
+@pytest.mark.parametrize('columnar', [False, True])
+def test_run_data_pipeline(mocker, tmpdir, overlap, batch_size, num_batches,
+                           columnar):
+    mocker.patch('crmprtd.create_engine')
+    mocker.patch('crmprtd.Aligner', FakeAligner)
+    inserted = []
+
+    def insert_batches(sesh, batches, *args, **kwargs):
+        inserted.extend(batches)
+        return {}
+    mocker.patch('crmprtd.insert_batches', insert_batches)
+
+    cache_file = tmpdir.join('cache')
+    run_data_pipeline(download_lines, normalize_lines, {'num_lines': 10},
+                      str(cache_file), 'postgresql://', None,
+                      batch_size=batch_size, overlap=overlap,
+                      columnar=columnar)
+
+    assert cache_file.read() == ''.join(download_lines(10))
+    assert len(inserted) == num_batches
+    assert [row for batch in inserted for row in batch] == \
+        list(normalize_lines(download_lines(10)))
+
+
+def test_run_data_pipeline_keeps_chunk_size(mocker, tmpdir):
+    mocker.patch('crmprtd.create_engine')
+    mocker.patch('crmprtd.Aligner', FakeAligner)
+    sizes = []
+
+    def insert_batches(sesh, batches, strategy, chunker, workers):
+        list(batches)
+        sizes.append(chunker.size)
+        chunker.size = 256
+        return {}
+    mocker.patch('crmprtd.insert_batches', insert_batches)
+
+    snapshot_file = tmpdir.join('meta.pickle')
+    for _ in range(2):
+        run_data_pipeline(download_lines, normalize_lines, {'num_lines': 10},
+                          None, 'postgresql://', None, str(snapshot_file))
+
+    assert tmpdir.join('meta.chunk_size').read() == '256\n'
+    assert sizes == [4096, 256]
@@ -1,6 +1,11 @@
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
 import pytest
 
-from crmprtd.download import extract_auth, https_download
+from crmprtd.download import extract_auth, https_download, \
+    configure_session, get_session, SessionPool
 
 
 @pytest.mark.parametrize(('user', 'password', 'expected'), (
@@ -28,5 +33,104 @@ def test_https_download(requests_mock, capsys):
 
 def test_https_download_404(requests_mock):
     requests_mock.register_uri('GET', 'https://test.com', status_code=404)
-    with pytest.raises(IOError):
+    with pytest.raises(IOError, match='HTTPS 404'):
         https_download('https://test.com')
+
+
+def test_https_download_scheme_is_deprecated(requests_mock, capsys):
+    requests_mock.get('https://test.com', text='data')
+    with pytest.deprecated_call():
+        https_download('https://test.com', 'https')
+    assert capsys.readouterr().out == 'data'
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'data'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def start_server():
+    '''Returns a function which starts a local keep-alive HTTP server
+       and returns its URL
+    '''
+    servers = []
+
+    def start():
+        server = ThreadingServer(('127.0.0.1', 0), KeepAliveHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        servers.append(server)
+        return 'http://127.0.0.1:{}/'.format(server.server_port)
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def keep_alive_server(start_server):
+    return start_server()
+
+
+def test_session_reuses_connections(keep_alive_server, capsys):
+    pool = configure_session(pool_size=2, retries=0, timeout=5)
+    try:
+        assert get_session() is pool
+        for _ in range(3):
+            https_download(keep_alive_server)
+        assert capsys.readouterr().out == 'data' * 3
+        assert pool.stats() == {'opened': 1, 'reused': 2}
+    finally:
+        configure_session()
+
+
+def test_session_per_thread(keep_alive_server):
+    pool = SessionPool(pool_size=2, retries=0, timeout=5)
+    sessions = []
+
+    def get():
+        pool.get(keep_alive_server)
+        sessions.append(pool.session)
+
+    try:
+        threads = [threading.Thread(target=get) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(set(map(id, sessions))) == 2
+        assert all(s.get_adapter(keep_alive_server) is pool.adapter
+                   for s in sessions)
+    finally:
+        pool.close()
+
+
+def test_session_stats_keep_evicted_pools(start_server):
+    # Only one host's connections are kept, so alternating between two
+    # servers evicts a pool with every request
+    first, second = start_server(), start_server()
+    pool = SessionPool(pool_size=1, retries=0, timeout=5)
+    try:
+        for url in (first, second, first):
+            pool.get(url)
+        assert pool.stats() == {'opened': 3, 'reused': 0}
+        pool.get(first)
+        assert pool.stats() == {'opened': 3, 'reused': 1}
+    finally:
+        pool.close()
+    assert pool.stats() == {'opened': 3, 'reused': 1}
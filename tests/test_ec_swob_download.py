@@ -1,10 +1,12 @@
 import io
+import time
 from datetime import datetime
 
 import pytest
 
 from .swob_data import multi_xml_bytes
-from crmprtd.ec_swob.download import match_date, get_url_list
+from crmprtd.ec_swob.download import match_date, get_url_list, crawl, \
+    download, RateLimiter
 from crmprtd.ec_swob.download import split_multi_xml_stream
 
 
@@ -18,12 +20,64 @@ def test_match_date(url, expected):
     assert match_date(url, date) == expected
 
 
-def test_get_url_list(swob_urls):
+def test_get_url_list(swob_urls, requests_mock):
     rv = get_url_list(
         'https://dd.weather.gc.ca/observations/swob-ml/partners/bc-env-snow/',
         datetime(2019, 10, 15, 1)
     )
-    assert list(rv)
+    urls = list(rv)
+    assert urls
+    assert len(set(urls)) == len(urls)
+    # Only the directory listings are fetched, not the files
+    assert not any(request.url in urls
+                   for request in requests_mock.request_history)
+
+
+BASE_URL = \
+    'https://dd.weather.gc.ca/observations/swob-ml/partners/bc-env-snow/'
+
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_crawl(swob_urls, requests_mock, concurrency):
+    date = datetime(2019, 10, 15, 1)
+    urls = list(get_url_list(BASE_URL, date))
+    for url in urls:
+        requests_mock.get(url, content=url.encode('utf-8'))
+
+    files = list(crawl(BASE_URL, date, concurrency))
+    assert sorted(url for url, _ in files) == sorted(urls)
+    assert all(content == url.encode('utf-8') for url, content in files)
+
+
+def test_crawl_error(swob_urls):
+    # The files themselves are not found
+    with pytest.raises(IOError):
+        list(crawl(BASE_URL, datetime(2019, 10, 15, 1)))
+
+
+def test_download(swob_urls, requests_mock, capsys):
+    date = datetime(2019, 10, 15, 1)
+    docs = []
+    for i, url in enumerate(get_url_list(BASE_URL, date)):
+        doc = '<?xml version="1.0"?><doc id="{}" />'.format(i)
+        requests_mock.get(url, text=doc)
+        docs.append(doc)
+
+    download(BASE_URL, date, concurrency=4)
+    out = capsys.readouterr().out
+    assert sorted(doc.getvalue().decode('utf-8') for doc in
+                  split_multi_xml_stream(io.BytesIO(out.encode('utf-8')))) \
+        == sorted(docs)
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(20)
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.wait('https://a.com/foo')
+    # Requests to another host are not held back
+    limiter.wait('https://b.com/foo')
+    assert 0.1 <= time.monotonic() - start < 0.5
 
 
 def test_split_multi_xml_stream():
@@ -35,3 +89,29 @@ def test_split_multi_xml_stream():
 <foo />
 '''
     assert isinstance(strings[0], io.IOBase)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 7, 4096])
+def test_split_multi_xml_stream_chunks(chunk_size):
+    stream = io.BytesIO(b'preamble' + multi_xml_bytes)
+    docs = [doc.getvalue()
+            for doc in split_multi_xml_stream(stream, chunk_size)]
+    assert len(docs) == 4
+    assert b''.join(docs) == multi_xml_bytes
+    assert all(doc.startswith(b'<?xml') for doc in docs)
+
+
+def test_split_multi_xml_stream_is_incremental():
+    class Stream(object):
+        def __init__(self, chunks):
+            self.chunks = iter(chunks)
+
+        def read(self, size):
+            return next(self.chunks)
+
+    docs = [b'<?xml version="1.0"?><foo />', b'<?xml version="1.0"?><bar />']
+    # The stream raises if it is read past the second chunk
+    stream = Stream(docs)
+
+    splitter = split_multi_xml_stream(stream)
+    assert next(splitter).getvalue() == docs[0]
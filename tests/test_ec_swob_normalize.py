@@ -2,14 +2,18 @@ from io import BytesIO
 import re
 import logging
 from collections import Iterable
+from datetime import datetime
 
 import pytest
+import pytz
 
 from .swob_data import multi_xml_download, MSNG_values_xml
 from crmprtd.bc_env_aq.normalize import normalize as norm_aq
 from crmprtd.bc_env_snow.normalize import normalize as norm_snow
 from crmprtd.bc_forestry.normalize import normalize as norm_forest
 from crmprtd.bc_tran.normalize import normalize as norm_tran
+from crmprtd.swob_ml import normalize, normalize_batches, get_transform
+from crmprtd import Row
 
 
 @pytest.mark.parametrize('function', [
@@ -36,3 +40,54 @@ def test_normalize_missing_values(caplog):
         next(iterator)
         # There should be 3 DEBUG log messages about skipping a MSNG value
         assert re.search(r'(Ignoring.*){3}', caplog.text)
+
+
+def test_normalize_rows():
+    rows = list(normalize(BytesIO(multi_xml_download), 'ENV-ASP',
+                          station_id_attr='msc_id'))
+    assert len(rows) == 87
+    assert rows[0] == Row(time=datetime(2019, 11, 5, 13, tzinfo=pytz.utc),
+                          val=-3.2, variable_name='air_temp_1', unit='°C',
+                          network_name='ENV-ASP',
+                          station_id='BC_ENV-ASW_1A01P',
+                          lat=52.9063, lon=-118.5478)
+
+
+def test_transform_is_compiled_once():
+    assert get_transform() is get_transform()
+
+
+@pytest.mark.parametrize('function', [
+    norm_aq,
+    norm_snow,
+    norm_forest,
+    norm_tran
+])
+def test_normalize_workers(function):
+    expected = list(function(BytesIO(multi_xml_download)))
+    assert list(function(BytesIO(multi_xml_download), workers=2)) == expected
+    rows = list(function(BytesIO(multi_xml_download), workers=2,
+                         ordered=False))
+    assert sorted(rows) == sorted(expected)
+
+
+@pytest.mark.parametrize(('batch_size', 'expected'), (
+    (None, [87]),
+    (40, [40, 40, 7]),
+    (87, [87]),
+))
+def test_normalize_batches(batch_size, expected):
+    rows = list(normalize(BytesIO(multi_xml_download), 'ENV-ASP',
+                          station_id_attr='msc_id'))
+    batches = list(normalize_batches(BytesIO(multi_xml_download), 'ENV-ASP',
+                                     station_id_attr='msc_id',
+                                     batch_size=batch_size))
+    assert [len(batch) for batch in batches] == expected
+    assert [row for batch in batches for row in batch] == rows
+
+
+def test_normalize_station_ids_are_plain_strings():
+    # Smart strings would keep each parsed document alive
+    rows = normalize(BytesIO(multi_xml_download), 'EC_raw',
+                     station_id_attr='msc_id')
+    assert all(type(row.station_id) is str for row in rows)
@@ -1,11 +1,19 @@
+import time
+from io import StringIO
 from datetime import datetime
 
 import pytest
 import pytz
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
 
 from pycds import History, Obs
 from crmprtd.insert import bisect_insert_strategy, split, chunks, \
-    get_sample_indices, obs_exist, contains_all_duplicates, single_insert_obs
+    copy_insert_strategy, insert, filter_existing, \
+    core_insert_strategy, AdaptiveChunker, load_chunk_size, \
+    save_chunk_size, shard, insert_batches, DBMetrics, pool_size, \
+    available_connections
+from crmprtd.align import ObsRecord
 
 
 @pytest.mark.parametrize(('label', 'days', 'expected'), [
@@ -79,60 +87,250 @@ def test_chunks(list_size, expected):
         assert len(chunk) in expected
 
 
-@pytest.mark.parametrize(('num_obs', 'num_samples', 'expected'), [
-    (500, 10, 10),
-    (10, 500, 10)
+@pytest.mark.parametrize(('label', 'days', 'expected'), [
+    ('unique', range(7), 7),
+    ('duplicates', [0 for _ in range(5)], 1),
+    ('none', [], 0)
 ])
-def test_get_sample_indices(num_obs, num_samples, expected):
-    sample_indices = get_sample_indices(num_obs, num_samples)
-    assert len(sample_indices) == expected
+def test_copy_insert_strategy(test_session, label, days, expected):
+    history = test_session.query(History).first()
+    variable = history.station.network.variables[0]
+
+    obs = [Obs(history_id=history.id, datum=2.5, vars_id=variable.id,
+               time=datetime(2017, 8, 6, d, tzinfo=pytz.utc))
+           for d in days]
 
+    dbm = copy_insert_strategy(test_session, obs)
+    assert dbm.successes == expected
+    assert dbm.skips == len(obs) - expected
+    assert dbm.failures == 0
 
-def test_obs_exist_not_in_db(test_session):
-    history_id = 20
-    vars_id = 2
-    time = datetime(2012, 10, 10, 6, tzinfo=pytz.utc)
-    assert not obs_exist(test_session, history_id, vars_id, time)
 
+def test_copy_insert_strategy_existing(test_session):
+    # The first observation is already in the database
+    obs = [Obs(history_id=20, vars_id=2, datum=2.5,
+               time=datetime(2012, 9, 24, 6, tzinfo=pytz.utc)),
+           Obs(history_id=20, vars_id=2, datum=2.5,
+               time=datetime(2012, 9, 25, 6, tzinfo=pytz.utc))]
 
-def test_obs_exist_in_db(test_session):
-    history_id = 20
-    vars_id = 2
-    time = datetime(2012, 9, 24, 6, tzinfo=pytz.utc)
-    assert obs_exist(test_session, history_id, vars_id, time)
+    dbm = copy_insert_strategy(test_session, obs)
+    assert dbm.successes == 1
+    assert dbm.skips == 1
+    assert test_session.query(Obs).count() == 4
 
 
-def test_contains_all_duplicates_no_dup(test_session):
-    obs_list = []
-    for i in range(50):
-        obs_list.append(Obs(history_id=20, vars_id=2,
-                            time=datetime.now(), datum=i))
+def test_copy_insert_strategy_falls_back(test_session):
+    # History 99 does not exist, violating a foreign key
+    obs = [Obs(history_id=20, vars_id=2, datum=2.5,
+               time=datetime(2012, 9, 25, 6, tzinfo=pytz.utc)),
+           Obs(history_id=99, vars_id=2, datum=2.5,
+               time=datetime(2012, 9, 25, 6, tzinfo=pytz.utc))]
 
-    assert not contains_all_duplicates(test_session, obs_list, 5)
+    dbm = copy_insert_strategy(test_session, obs)
+    assert dbm.successes == 1
+    assert dbm.skips == 1
 
 
-def test_contains_all_duplicates_all_dup(test_session):
-    obs_list = []
-    for i in range(50):
-        obs_list.append(Obs(history_id=20,
-                            vars_id=2,
-                            time=datetime(2012, 9, 24, 6, tzinfo=pytz.utc),
-                            datum=i))
+def test_copy_insert_strategy_copy_fails(test_session, mocker):
+    obs = [Obs(history_id=20, vars_id=2, datum=2.5,
+               time=datetime(2012, 9, 25, h, tzinfo=pytz.utc))
+           for h in range(6, 8)]
+    # A value that the staging table can not accept fails the COPY itself
+    mocker.patch('crmprtd.insert.copy_rows',
+                 return_value=StringIO('20\t2\tnot a time\t2.5\n'))
+
+    dbm = copy_insert_strategy(test_session, obs)
+    assert dbm.successes == 2
+    assert dbm.rollbacks >= 1
+
+
+@pytest.mark.parametrize('strategy', ['bisect', 'copy', 'core'])
+@pytest.mark.parametrize('obs_class', [Obs, ObsRecord])
+def test_insert_strategies_agree(test_session, strategy, obs_class):
+    obs = [obs_class(history_id=20, vars_id=2, datum=2.5,
+                     time=datetime(2012, 9, 24, h, tzinfo=pytz.utc))
+           for h in range(6, 12)]
+
+    results = insert(test_session, obs, 5, strategy)
+    assert results['successes'] == 5
+    assert results['skips'] == 1
+    assert results['failures'] == 0
+    assert 'insertions_per_sec' in results
+
+
+def test_filter_existing(test_session):
+    obs = [Obs(history_id=20, vars_id=2, datum=2.5,
+               time=datetime(2012, 9, 24, h, tzinfo=pytz.utc))
+           for h in range(6, 12)]
+    # A repeat within the batch
+    obs.append(Obs(history_id=20, vars_id=2, datum=2.5,
+                   time=datetime(2012, 9, 24, 11, tzinfo=pytz.utc)))
+    # Same time, different variable
+    obs.append(Obs(history_id=20, vars_id=1, datum=2.5,
+                   time=datetime(2012, 9, 24, 6, tzinfo=pytz.utc)))
+
+    new_obs, num_existing = filter_existing(test_session, obs)
+    assert num_existing == 2
+    assert len(new_obs) == 6
+    assert datetime(2012, 9, 24, 6, tzinfo=pytz.utc) not in \
+        {o.time for o in new_obs if o.vars_id == 2}
+
+
+def test_filter_existing_naive_times(ec_session):
+    obs = [Obs(history_id=20000, vars_id=101, datum=2.5,
+               time=datetime(2012, 9, 24, 6)),
+           Obs(history_id=20000, vars_id=101, datum=2.5,
+               time=datetime(2012, 9, 24, 7))]
+    new_obs, num_existing = filter_existing(ec_session, obs)
+    assert num_existing == 1
+    assert [o.time for o in new_obs] == [datetime(2012, 9, 24, 7)]
+
+
+@pytest.mark.parametrize('page_size', [1, 2, 1000])
+def test_core_insert_strategy(test_session, page_size):
+    # The first observation is already in the database
+    obs = [ObsRecord(history_id=20, vars_id=2, datum=2.5,
+                     time=datetime(2012, 9, 24, h, tzinfo=pytz.utc))
+           for h in range(6, 11)]
+
+    dbm = core_insert_strategy(test_session, obs, page_size)
+    assert dbm.successes == 4
+    assert dbm.skips == 1
+    assert test_session.query(Obs).count() == 7
 
-    assert contains_all_duplicates(test_session, obs_list, 5)
 
+def test_core_insert_strategy_falls_back(test_session):
+    # History 99 does not exist, violating a foreign key
+    obs = [ObsRecord(history_id=20, vars_id=2, datum=2.5,
+                     time=datetime(2012, 9, 25, 6, tzinfo=pytz.utc)),
+           ObsRecord(history_id=99, vars_id=2, datum=2.5,
+                     time=datetime(2012, 9, 25, 6, tzinfo=pytz.utc))]
 
-def test_single_insert_obs(test_session):
-    ob = [Obs(history_id=20, vars_id=2, time=datetime.now(), datum=10)]
-    dbm = single_insert_obs(test_session, ob)
+    dbm = core_insert_strategy(test_session, obs)
     assert dbm.successes == 1
+    assert dbm.skips == 1
 
-    q = test_session.query(Obs)
-    assert q.count() == 4
 
+def test_bisect_insert_strategy_counts_savepoints(test_session):
+    obs = [Obs(history_id=20, vars_id=2, datum=2.5,
+               time=datetime(2012, 9, 24, h, tzinfo=pytz.utc))
+           for h in range(6, 10)]
 
-def test_single_insert_obs_not_unique(test_session):
-    ob = [Obs(history_id=20, vars_id=2,
-              time=datetime(2012, 9, 24, 6, tzinfo=pytz.utc), datum=10)]
-    dbm = single_insert_obs(test_session, ob)
+    # The first observation already exists: the set fails, [0, 1] fails,
+    # [0] fails, [1] and [2, 3] succeed
+    dbm = bisect_insert_strategy(test_session, obs)
+    assert dbm.successes == 3
     assert dbm.skips == 1
+    assert dbm.savepoints == 5
+    assert dbm.rollbacks == 3
+
+
+def test_adaptive_chunker():
+    chunker = AdaptiveChunker(size=4, max_size=16)
+    sizes = []
+    for chunk in chunker.chunks(list(range(40))):
+        sizes.append(len(chunk))
+        if len(sizes) == 3:
+            # 2 failures in 16 observations
+            chunker.failed(len(chunk), 2)
+        else:
+            chunker.succeeded()
+    assert sizes == [4, 8, 16, 4, 8]
+
+
+@pytest.mark.parametrize(('size', 'expected'), [
+    (0, 1),
+    (10 ** 6, 65536),
+])
+def test_adaptive_chunker_bounds(size, expected):
+    assert AdaptiveChunker(size).size == expected
+
+
+def test_chunk_size_persistence(tmpdir):
+    path = str(tmpdir.join('wmb.chunk_size'))
+    assert load_chunk_size(path, 512) == 512
+    save_chunk_size(path, 128)
+    assert load_chunk_size(path, 512) == 128
+
+
+def test_shard():
+    obs = [ObsRecord(history_id=h, vars_id=1, time=None, datum=1)
+           for h in (1, 2, 3, 4, 5, 5)]
+    shards = shard(obs, 2)
+    assert len(shards) == 2
+    for s in shards:
+        assert len({o.history_id % 2 for o in s}) == 1
+    assert sorted(len(s) for s in shards) == [2, 4]
+
+
+@pytest.mark.parametrize('strategy', ['bisect', 'core'])
+def test_insert_workers(test_session, strategy):
+    # The fixture data is committed, so each worker's connection sees it
+    obs = [ObsRecord(history_id=history_id, vars_id=2, datum=2.5,
+                     time=datetime(2012, 9, 24, h, tzinfo=pytz.utc))
+           for history_id in (20, 21) for h in range(6, 12)]
+
+    results = insert(test_session, obs, strategy=strategy, workers=2)
+    assert results['successes'] == 11
+    assert results['skips'] == 1
+    assert results['failures'] == 0
+
+
+def test_insert_batches(test_session):
+    obs = [ObsRecord(history_id=20, vars_id=2, datum=2.5,
+                     time=datetime(2012, 9, 24, h, tzinfo=pytz.utc))
+           for h in range(6, 12)]
+    batches = (obs[i:i+2] for i in range(0, len(obs), 2))
+
+    results = insert_batches(test_session, batches, 'core')
+    assert results['successes'] == 5
+    assert results['skips'] == 1
+    assert results['failures'] == 0
+
+
+def test_insert_batches_times_only_insertion(mocker):
+    mocker.patch('crmprtd.insert.insert_observations',
+                 return_value=DBMetrics(100, 0, 0))
+
+    def slow_batches():
+        for _ in range(2):
+            time.sleep(0.5)
+            yield []
+
+    results = insert_batches(None, slow_batches())
+    assert results['successes'] == 200
+    # Producing the batches took over a second
+    assert results['insertions_per_sec'] > 1000
+
+
+@pytest.mark.parametrize(('workers', 'expected'), [
+    (1, 5),
+    (4, 6),
+    (16, 18)
+])
+def test_pool_size(workers, expected):
+    assert pool_size(workers) == expected
+
+
+def test_available_connections():
+    engine = create_engine('sqlite://', poolclass=QueuePool, pool_size=2,
+                           max_overflow=1)
+    assert available_connections(engine) == 3
+    with engine.connect():
+        assert available_connections(engine) == 2
+
+
+def test_insert_batches_caps_workers(mocker):
+    engine = create_engine('sqlite://', poolclass=QueuePool, pool_size=1,
+                           max_overflow=1)
+    sesh = mocker.Mock(get_bind=mocker.Mock(return_value=engine))
+    parallel_insert = mocker.patch('crmprtd.insert.parallel_insert',
+                                   return_value=DBMetrics(1, 0, 0))
+
+    results = insert_batches(sesh, [[], []], workers=8)
+    assert results['successes'] == 2
+    # One executor for all of the batches, with no more workers than
+    # there are connections
+    (_, _, workers, _, _, executor, _), _ = parallel_insert.call_args
+    assert workers == 2
+    assert {c[0][5] for c in parallel_insert.call_args_list} == {executor}
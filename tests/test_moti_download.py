@@ -60,9 +60,8 @@ def test_download(stime, etime, station_id, expected_payload, mocker):
     mocker.patch('crmprtd.moti.download.utcnow', return_value=now)
     download('u', 'p', None, None, stime, etime, station_id)
     crmprtd.download.https_download.assert_called_once()
-    call_args, _ = crmprtd.download.https_download.call_args
-    _, _, _, _, payload = call_args
-    assert payload == expected_payload
+    _, call_kwargs = crmprtd.download.https_download.call_args
+    assert call_kwargs['payload'] == expected_payload
 
 
 @pytest.mark.parametrize('stime etime'.split(), (
@@ -1,7 +1,9 @@
-from crmprtd.moti.normalize import normalize
+from crmprtd.moti.normalize import normalize, normalize_xslt
 from io import BytesIO
 import logging
 
+from lxml.etree import tostring
+
 import pytest
 
 
@@ -316,3 +318,15 @@ def test_normalize_empty_data(empty, caplog):
         assert record.levelno != logging.ERROR
         if record.levelno == logging.WARNING:
             assert "Empty observation series:" in caplog.text
+
+
+@pytest.mark.parametrize('fixture', (
+    'moti_sawr7110_xml', 'moti_sawr7110_xml_2a', 'moti_sawr7110_xml_2b',
+    'moti_sawr7100_large'
+))
+def test_normalize_matches_xslt(fixture, request):
+    lines = tostring(request.getfixturevalue(fixture))
+    rows = list(normalize(BytesIO(lines)))
+    assert rows
+    assert rows == list(normalize_xslt(BytesIO(lines)))
+    assert 'CURRENT_AIR_TEMPERATURE1' in {row.variable_name for row in rows}
@@ -0,0 +1,31 @@
+from io import BytesIO
+
+import pytest
+
+from crmprtd.normalize import normalize
+from crmprtd.rowbatch import read_batches, read_rows
+from crmprtd.wmb.normalize import normalize as wmb_normalize
+
+
+@pytest.mark.parametrize(('frame_size', 'expected'), (
+    (100, [100, 100, 16]),
+    (1000, [216]),
+))
+def test_normalize(wmb_data, frame_size, expected):
+    output = BytesIO()
+    assert normalize('wmb', BytesIO(wmb_data), output,
+                     frame_size=frame_size) == 216
+
+    output.seek(0)
+    assert [len(batch) for batch in read_batches(output)] == expected
+    output.seek(0)
+    assert list(read_rows(output)) == list(wmb_normalize(BytesIO(wmb_data)))
+
+
+def test_normalize_unsupported_workers():
+    lines = b'''DATE_PST,STATION_NAME,RAW_VALUE,REPORTED_VALUE,INSTRUMENT,UNITS,PARAMETER,EMS_ID,LATITUDE,LONGITUDE
+2020-07-04 22:00,Abbotsford A Columbia Street,80.7,80.7,HUMIDITY,% RH,HUMIDITY,E289309,49.0215,-122.3266
+'''  # noqa
+    output = BytesIO()
+    assert normalize('wamr', BytesIO(lines), output,
+                     normalize_workers=2) == 1
@@ -0,0 +1,89 @@
+import io
+import sys
+
+import pytest
+
+from crmprtd.process import process, get_normalization_module, \
+    supports_workers, normalize_stream
+from crmprtd.wmb.normalize import normalize as wmb_normalize
+
+
+WAMR_DATA = b'''DATE_PST,STATION_NAME,RAW_VALUE,REPORTED_VALUE,INSTRUMENT,UNITS,PARAMETER,EMS_ID,LATITUDE,LONGITUDE
+2020-07-04 22:00,Abbotsford A Columbia Street,80.7,80.7,HUMIDITY,% RH,HUMIDITY,E289309,49.0215,-122.3266
+'''  # noqa
+
+
+class FakeAligner(object):
+    '''Stands in for the Aligner, "aligning" rows to themselves'''
+    def __init__(self, sesh, *args, **kwargs):
+        self.sesh = sesh
+
+    def align_batch(self, rows):
+        return list(rows)
+
+    def cache_stats(self):
+        return {}
+
+
+@pytest.fixture
+def pipeline(mocker, wmb_data):
+    mocker.patch('crmprtd.process.create_engine')
+    mocker.patch('crmprtd.process.Aligner', FakeAligner)
+    inserted = []
+
+    def insert_batches(sesh, batches, *args):
+        batches = list(batches)
+        inserted.append(batches)
+        return {}
+
+    mocker.patch('crmprtd.process.insert_batches', insert_batches)
+    mocker.patch.object(sys, 'stdin', io.TextIOWrapper(io.BytesIO(wmb_data)))
+    return inserted
+
+
+@pytest.mark.parametrize(('overlap', 'batch_size', 'num_batches'), (
+    (False, None, 1),
+    (False, 100, 3),
+    (True, None, 1),
+    (True, 100, 3),
+))
+@pytest.mark.parametrize('columnar', [False, True])
+def test_process(pipeline, wmb_data, overlap, batch_size, num_batches,
+                 columnar):
+    process('postgresql://', None, 'wmb', batch_size=batch_size,
+            overlap=overlap, columnar=columnar)
+    batches, = pipeline
+    assert len(batches) == num_batches
+    assert [row for batch in batches for row in batch] == \
+        list(wmb_normalize(io.BytesIO(wmb_data)))
+
+
+@pytest.mark.parametrize(('network', 'expected'), (
+    ('bc_env_aq', True),
+    ('bc_env_snow', True),
+    ('bc_forestry', True),
+    ('bc_tran', True),
+    ('crd', False),
+    ('ec', True),
+    ('moti', False),
+    ('wamr', False),
+    ('wmb', True),
+))
+def test_supports_workers(network, expected):
+    assert supports_workers(get_normalization_module(network)) == expected
+
+
+def test_normalize_stream_unsupported_workers():
+    norm_mod = get_normalization_module('wamr')
+    # The workers are ignored rather than passed on
+    rows = list(normalize_stream(norm_mod, io.BytesIO(WAMR_DATA), workers=2))
+    assert rows == list(norm_mod.normalize(io.BytesIO(WAMR_DATA)))
+    assert len(rows) == 1
+
+
+def test_process_unsupported_workers(pipeline, mocker):
+    mocker.patch.object(sys, 'stdin',
+                        io.TextIOWrapper(io.BytesIO(WAMR_DATA)))
+    process('postgresql://', None, 'wamr', normalize_workers=2)
+    batches, = pipeline
+    assert len(batches[0]) == 1
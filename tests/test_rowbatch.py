@@ -0,0 +1,121 @@
+from io import BytesIO
+from datetime import datetime
+
+import pytest
+import pytz
+
+from crmprtd import Row
+from crmprtd.rowbatch import RowBatch, write_batches, read_batches, \
+    read_rows
+
+
+def make_rows(n):
+    return [
+        Row(time=datetime(2019, 6, 15, hour % 24, tzinfo=pytz.utc),
+            val=float(hour),
+            variable_name='temperature',
+            unit='celsius',
+            network_name='FLNRO-WMB',
+            station_id=str(hour % 3),
+            lat=None,
+            lon=None)
+        for hour in range(n)
+    ]
+
+
+def test_round_trip():
+    rows = make_rows(10)
+    batch = RowBatch(rows)
+    assert len(batch) == 10
+    assert list(batch) == rows
+    assert batch.row(3) == rows[3]
+
+
+def test_dictionary_encoding():
+    batch = RowBatch(make_rows(30))
+    assert batch.network_name.values == ['FLNRO-WMB']
+    assert batch.station_id.values == ['0', '1', '2']
+    assert list(batch.station_id.codes[:4]) == [0, 1, 2, 0]
+
+
+def test_missing_time_and_val():
+    row = Row(None, None, 'temperature', None, 'FLNRO-WMB', '1', None, None)
+    batch = RowBatch([row])
+    assert batch.time(0) is None
+    assert batch.val(0) is None
+    assert list(batch) == [row]
+
+
+def test_times_are_utc():
+    pacific = pytz.timezone('Canada/Pacific')
+    t = pacific.localize(datetime(2019, 6, 15, 1))
+    batch = RowBatch()
+    batch.append(t, 1, 'temperature', 'celsius', 'FLNRO-WMB', '1', 49.5,
+                 -123.5)
+    assert batch.time(0) == t
+    assert batch.time(0).tzinfo == pytz.utc
+
+
+def test_naive_time():
+    with pytest.raises(ValueError):
+        RowBatch([Row(datetime(2019, 6, 15), 1, 'temperature', 'celsius',
+                      'FLNRO-WMB', '1', None, None)])
+
+
+@pytest.mark.parametrize(('n', 'batch_size', 'expected'), (
+    (10, 4, [4, 4, 2]),
+    (8, 4, [4, 4]),
+    (0, 4, []),
+    (10, None, [10]),
+    (0, None, [0]),
+))
+def test_batches(n, batch_size, expected):
+    rows = make_rows(n)
+    batches = list(RowBatch.batches(iter(rows), batch_size))
+    assert [len(batch) for batch in batches] == expected
+    assert [row for batch in batches for row in batch] == rows
+
+
+def test_to_bytes_round_trip():
+    rows = make_rows(10)
+    rows.append(Row(None, None, None, None, 'FLNRO-WMB', 'x', 49.45, -123.7))
+    batch = RowBatch.from_bytes(RowBatch(rows).to_bytes())
+    assert list(batch) == rows
+    assert batch.station_id.values == ['0', '1', '2', 'x']
+
+
+def test_write_read_batches():
+    rows = make_rows(10)
+    stream = BytesIO()
+    write_batches(RowBatch.batches(rows, 4), stream)
+    stream.seek(0)
+    assert [len(batch) for batch in read_batches(stream)] == [4, 4, 2]
+    stream.seek(0)
+    assert list(read_rows(stream)) == rows
+
+
+@pytest.mark.parametrize('data', (
+    b'',
+    b'not a normalized stream',
+))
+def test_read_batches_bad_header(data):
+    with pytest.raises(ValueError):
+        list(read_batches(BytesIO(data)))
+
+
+def test_read_batches_truncated():
+    stream = BytesIO()
+    write_batches([RowBatch(make_rows(10))], stream)
+    data = stream.getvalue()
+    with pytest.raises(ValueError):
+        list(read_batches(BytesIO(data[:-1])))
+
+
+@pytest.mark.parametrize('n', [0, 4, 10])
+def test_split(n):
+    rows = make_rows(10)
+    head, tail = RowBatch(rows).split(n)
+    assert list(head) == rows[:n]
+    assert list(tail) == rows[n:]
+    tail.append_row(rows[0])
+    assert list(tail) == rows[n:] + rows[:1]
@@ -0,0 +1,122 @@
+import time
+from queue import Queue, Empty
+
+import pytest
+
+from crmprtd.stages import threaded, in_process, parallel_map, _consume
+
+
+def double(items):
+    for item in items:
+        yield item * 2
+
+
+def fail_after_two(items):
+    for i, item in enumerate(items):
+        if i == 2:
+            raise ValueError('Bad item')
+        yield item
+
+
+@pytest.mark.parametrize('batch_size', [1, 3, 100])
+def test_threaded(batch_size):
+    assert list(threaded(range(10), batch_size=batch_size)) == list(range(10))
+
+
+def test_threaded_raises():
+    items = threaded(fail_after_two(range(10)))
+    assert next(items) == 0
+    assert next(items) == 1
+    with pytest.raises(ValueError):
+        next(items)
+
+
+def test_threaded_backpressure():
+    produced = []
+
+    def items():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    it = threaded(items(), maxsize=2)
+    time.sleep(0.2)
+    # Two batches in the queue and one waiting to be put
+    assert len(produced) == 3
+    assert list(it) == list(range(100))
+
+
+def test_threaded_stages_chain():
+    stages = threaded(double(threaded(range(5))))
+    assert list(stages) == [0, 2, 4, 6, 8]
+
+
+@pytest.mark.parametrize('batch_size', [1, 256])
+def test_in_process(batch_size):
+    assert list(in_process(double, range(10), batch_size=batch_size)) == \
+        [i * 2 for i in range(10)]
+
+
+def test_in_process_raises():
+    with pytest.raises(ValueError):
+        list(in_process(fail_after_two, range(10)))
+
+
+def test_in_process_input_raises():
+    with pytest.raises(ValueError):
+        list(in_process(double, fail_after_two(range(10))))
+
+
+def square(x):
+    return x * x
+
+
+@pytest.mark.parametrize('max_pending', [None, 1, 3])
+def test_parallel_map(max_pending):
+    results = parallel_map(square, iter(range(10)), 2,
+                           max_pending=max_pending)
+    assert list(results) == [x * x for x in range(10)]
+
+
+def test_parallel_map_unordered():
+    results = parallel_map(square, range(10), 2, ordered=False)
+    assert sorted(results) == [x * x for x in range(10)]
+
+
+class ExitedProcess(object):
+    def is_alive(self):
+        return False
+
+    def join(self):
+        pass
+
+
+class LateQueue(Queue):
+    '''A queue whose items arrive only after the first get() has timed
+       out, as when a process exits with its last items in transit
+    '''
+    late = True
+
+    def get(self, *args, **kwargs):
+        if self.late:
+            self.late = False
+            raise Empty()
+        return super(LateQueue, self).get(*args, **kwargs)
+
+
+def test_consume_drains_exited_process():
+    queue = LateQueue()
+    queue.put([1, 2])
+    queue.put([3])
+    queue.put(None)
+    assert list(_consume(queue, process=ExitedProcess())) == [1, 2, 3]
+
+
+def test_consume_exited_process():
+    queue = LateQueue()
+    queue.put([1, 2])
+    items = _consume(queue, process=ExitedProcess())
+    assert next(items) == 1
+    assert next(items) == 2
+    with pytest.raises(RuntimeError):
+        next(items)
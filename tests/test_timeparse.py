@@ -0,0 +1,56 @@
+from datetime import datetime
+
+import pytest
+import pytz
+from dateutil.parser import parse as dateparse
+
+from crmprtd.timeparse import parse_local, parse_utc
+
+
+pacific = pytz.timezone('Canada/Pacific')
+
+
+@pytest.mark.parametrize(('string', 'fmt'), (
+    ('2018052711', '%Y%m%d%H'),
+    ('20200101000000', '%Y%m%d%H%M%S'),
+    ('2019-06-15 01:00', None),
+    ('2019/06/15 1:00 AM', None),
+    # Ambiguous (the end of DST)
+    ('2019-11-03 01:30', None),
+    # Non-existent (the start of DST)
+    ('2019-03-10 02:30', None),
+    ('2019031002', '%Y%m%d%H'),
+))
+def test_parse_local(string, fmt):
+    naive = datetime.strptime(string, fmt) if fmt else dateparse(string)
+    expected = pacific.localize(naive).astimezone(pytz.utc)
+    assert parse_local(string, fmt) == expected
+    assert parse_local(string, fmt).tzinfo == pytz.utc
+
+
+def test_parse_local_ambiguous_is_standard_time():
+    assert parse_local('2019-11-03 01:30') == \
+        datetime(2019, 11, 3, 9, 30, tzinfo=pytz.utc)
+
+
+@pytest.mark.parametrize('string', (
+    '2016-05-28T02:00:00.000Z',
+    '2012-01-01T00:00:00-08:00',
+    '2019-11-05T13:00:00.000Z',
+))
+def test_parse_utc(string):
+    assert parse_utc(string) == dateparse(string).astimezone(pytz.utc)
+    assert parse_utc(string).tzinfo == pytz.utc
+
+
+@pytest.mark.parametrize('func', (parse_local, parse_utc))
+def test_parse_bad_string(func):
+    with pytest.raises(ValueError):
+        func('not a time')
+
+
+def test_parse_local_is_memoized():
+    parse_local.cache_clear()
+    first = parse_local('2018052711', '%Y%m%d%H')
+    assert parse_local('2018052711', '%Y%m%d%H') is first
+    assert parse_local.cache_info().hits == 1
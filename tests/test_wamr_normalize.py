@@ -53,3 +53,27 @@ BAD_DATE,0250009,Trail Butler Park Met_60,HUMIDITY,HUMIDITY,HUMIDITY,11.68,% RH,
 ''' # noqa
     rows = [row for row in normalize(BytesIO(lines))]
     assert len(rows) == 0
+
+
+@pytest.mark.parametrize(('unit', 'expected'), (
+    ('% RH', '%'),
+    ('°C', 'celsius'),
+    ('mb', 'millibar'),
+    ('m/s', 'm/s'),
+))
+def test_normalize_units(unit, expected):
+    lines = '''DATE_PST,STATION_NAME,UNITS,PARAMETER,REPORTED_VALUE
+2020-07-04 22:00,Abbotsford,{},HUMIDITY,80.7
+'''.format(unit).encode('utf-8')
+    rows = [row for row in normalize(BytesIO(lines))]
+    assert len(rows) == 1
+    assert rows[0].unit == expected
+
+
+def test_normalize_is_incremental():
+    def lines():
+        yield b'DATE_PST,STATION_NAME,UNITS,PARAMETER,REPORTED_VALUE\n'
+        yield b'2020-07-04 22:00,Abbotsford,% RH,HUMIDITY,80.7\n'
+        raise AssertionError('Read past the first row')
+
+    assert next(normalize(lines())).val == 80.7
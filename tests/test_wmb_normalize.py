@@ -2,7 +2,9 @@ from io import BytesIO
 from datetime import datetime
 import pytz
 
-from crmprtd.wmb.normalize import normalize
+from crmprtd.wmb.normalize import normalize, normalize_batches
+
+import pytest
 
 
 def test_normalize_good_data():
@@ -45,3 +47,23 @@ def test_normalize_bad_value():
         assert row.variable_name is not None
         assert row.val is not None
         assert row.network_name is not None
+
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 1000])
+def test_normalize_workers(wmb_data, chunk_size):
+    expected = list(normalize(BytesIO(wmb_data)))
+    assert len(expected) == 3 * 24 * 3
+    rows = list(normalize(BytesIO(wmb_data), workers=2, chunk_size=chunk_size))
+    assert rows == expected
+
+
+@pytest.mark.parametrize(('batch_size', 'expected'), (
+    (None, [216]),
+    (100, [100, 100, 16]),
+    (216, [216]),
+))
+def test_normalize_batches(wmb_data, batch_size, expected):
+    batches = list(normalize_batches(BytesIO(wmb_data), batch_size))
+    assert [len(batch) for batch in batches] == expected
+    assert [row for batch in batches for row in batch] == \
+        list(normalize(BytesIO(wmb_data)))